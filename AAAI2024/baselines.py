@@ -0,0 +1,121 @@
+import numpy as np
+
+'''
+Vectorized reference mechanisms. Sellers and buyers are ranked best-first,
+in the reverse of the order the (key, id) heaps would pop them, so that
+ties between equal values are resolved exactly as in DAs.align/match.
+'''
+
+
+def rank_sellers(val, ids):
+    # Heap key (-value, id): ascending value, then descending id
+    order = np.lexsort((ids, -val))[::-1]
+    return val[order], ids[order]
+
+
+def rank_buyers(val, ids):
+    # Heap key (value, id): descending value, then descending id
+    order = np.lexsort((ids, val))[::-1]
+    return val[order], ids[order]
+
+
+def crossing(s_val, b_val):
+    # Number of efficient trades between best-first sellers and buyers
+    m = min(len(s_val), len(b_val))
+    return int(np.searchsorted(s_val[:m] - b_val[:m], 0, side="right"))
+
+
+def trade_reduction(s_val, b_val, k):
+    '''
+    McAfee's trade reduction on top of the k efficient pairs.
+    Returns the number of trades kept and the reserve prices (p_s, p_b),
+    which stay -1 when nobody trades.
+    '''
+    if k == 0:
+        return 0, -1, -1
+
+    flag = False
+    if k < min(len(s_val), len(b_val)):
+        p_0 = (-s_val[k] + b_val[k]) / 2 # same keys as the popped heap entries
+        if s_val[k-1] <= p_0 <= b_val[k-1]:
+            flag = True # k pairs
+    if not flag: # k-1 pairs
+        k -= 1
+    if k == 0:
+        return 0, -1, -1
+    return k, int(s_val[k-1]), int(b_val[k-1])
+
+
+def welfare(seller_total, s_val, b_val, k):
+    # Unsold sellers keep their items, the first k buyers receive one
+    return seller_total - int(s_val[:k].sum()) + int(b_val[:k].sum())
+
+
+def optimal(val, s):
+    s_val = np.sort(val[:s])
+    b_val = np.sort(val[s:])[::-1]
+    return welfare(int(s_val.sum()), s_val, b_val, crossing(s_val, b_val))
+
+
+def rank_batch(val, s, mask):
+    '''
+    Best-first rankings of B instances at once. Row i ranks its traders in
+    mask[i] the same way rank_sellers/rank_buyers would, followed by the rest.
+    '''
+    ids = np.broadcast_to(np.arange(val.shape[1]), val.shape)
+    seller = ids < s[:, None]
+    s_ok = seller & mask
+    b_ok = ~seller & mask
+
+    s_ids = np.lexsort((-ids, val, ~s_ok), axis=1)
+    b_ids = np.lexsort((-ids, -val, ~b_ok), axis=1)
+    s_val = np.take_along_axis(val, s_ids, axis=1)
+    b_val = np.take_along_axis(val, b_ids, axis=1)
+    return s_val, s_ids, s_ok.sum(axis=1), b_val, b_ids, b_ok.sum(axis=1)
+
+
+def crossing_batch(s_val, s_cnt, b_val, b_cnt):
+    # Row-wise crossing: s_val - b_val is nondecreasing over the first min(s_cnt, b_cnt) pairs
+    m = np.minimum(s_cnt, b_cnt)
+    pos = np.arange(s_val.shape[1])
+    return ((s_val <= b_val) & (pos < m[:, None])).sum(axis=1), m
+
+
+def trade_reduction_batch(s_val, b_val, k, m):
+    # Row-wise trade_reduction
+    rows = np.arange(len(k))
+    nxt = np.minimum(k, s_val.shape[1]-1)
+    cur = np.maximum(k-1, 0)
+    p_0 = (-s_val[rows, nxt] + b_val[rows, nxt]) / 2
+    flag = (k > 0) & (k < m) & (s_val[rows, cur] <= p_0) & (p_0 <= b_val[rows, cur])
+    k = np.where(flag | (k == 0), k, k-1)
+
+    cur = np.maximum(k-1, 0)
+    p_s = np.where(k > 0, s_val[rows, cur], -1)
+    p_b = np.where(k > 0, b_val[rows, cur], -1)
+    return k, p_s, p_b
+
+
+def welfare_batch(seller_total, s_val, b_val, k):
+    kept = np.arange(s_val.shape[1]) < k[:, None]
+    return seller_total - (s_val * kept).sum(axis=1) + (b_val * kept).sum(axis=1)
+
+
+def baselines_batch(val, s, invited):
+    '''
+    Optimal and MTR welfare of B instances given as (B, N) valuations,
+    seller counts s and initial participant masks. Also returns the MTR
+    rankings, trade counts and reserve prices the diffusion starts from.
+    '''
+    seller_total = (val * (np.arange(val.shape[1]) < s[:, None])).sum(axis=1)
+
+    s_val, s_ids, s_cnt, b_val, b_ids, b_cnt = rank_batch(val, s, np.ones(val.shape, dtype=bool))
+    k, m = crossing_batch(s_val, s_cnt, b_val, b_cnt)
+    res0 = welfare_batch(seller_total, s_val, b_val, k)
+
+    s_val, s_ids, s_cnt, b_val, b_ids, b_cnt = rank_batch(val, s, invited)
+    k, m = crossing_batch(s_val, s_cnt, b_val, b_cnt)
+    k, p_s, p_b = trade_reduction_batch(s_val, b_val, k, m)
+    res1 = welfare_batch(seller_total, s_val, b_val, k)
+
+    return res0, res1, (s_val, s_ids, s_cnt, b_val, b_ids, b_cnt, k, p_s, p_b)
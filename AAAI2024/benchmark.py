@@ -0,0 +1,171 @@
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+from multiprocessing import get_context
+from random import Random
+import igraph as ig
+import numpy as np
+from experiment import DAs
+from online import OnlineDA
+from stats import Stats
+
+'''
+Scaling benchmark of the double-auction mechanisms. Every grid point runs in
+a fresh process, so its peak RSS is not inflated by earlier points, and the
+results are written as JSON to compare revisions.
+'''
+
+NS = [10**3, 10**4, 10**5, 10**6]
+CONNECT_PROBS = [0.0001, 0.001, 0.01, 0.1]
+INITIAL_FRACS = [0.1, 0.3]
+STAGES = ["gen", "Optimal", "MTRForInit", "solve"]
+
+
+def run_point(N, CONNECT_PROB, INITIAL_PARTICIPANT_NUM, trials, seed):
+    DA = DAs()
+    times = {stage: 0 for stage in STAGES}
+    for i in range(trials):
+        rng = Random("{}-{}".format(seed, i))
+        ig.set_random_number_generator(rng)
+        DA.stats = Stats()
+        DA.gen(N, N//2, N//2, 0, 10000, 0.3, CONNECT_PROB, INITIAL_PARTICIPANT_NUM, 0, rng=rng)
+        t = time.perf_counter()
+        DA.solve()
+        times["solve"] += time.perf_counter()-t
+        for stage in ("gen", "Optimal", "MTRForInit"):
+            times[stage] += DA.stats.times[stage]
+
+    return {
+        "N": N,
+        "CONNECT_PROB": CONNECT_PROB,
+        "INITIAL_PARTICIPANT_NUM": INITIAL_PARTICIPANT_NUM,
+        "edges": int(DA.offsets[-1]) // 2,
+        "trials": trials,
+        "seconds": {stage: times[stage]/trials for stage in STAGES},
+        "trials_per_sec": trials / (times["gen"] + times["solve"]),
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+
+def run_online(events, VL=0, VR=10000, seed=0):
+    # Events/sec of OnlineDA on a random stream of arrivals (2/3) and departures (1/3)
+    rng = Random(seed)
+    D = OnlineDA(VL, VR)
+    sellers, buyers = [], []
+    t = time.perf_counter()
+    for i in range(events):
+        is_seller = rng.random() < 0.5
+        side = sellers if is_seller else buyers
+        if len(side) == 0 or rng.random() < 2/3:
+            v = rng.randint(VL, VR)
+            side.append(v)
+            if is_seller:
+                D.add_seller(v)
+            else:
+                D.add_buyer(v)
+        else:
+            j = rng.randrange(len(side))
+            side[j], side[-1] = side[-1], side[j]
+            v = side.pop()
+            if is_seller:
+                D.remove_seller(v)
+            else:
+                D.remove_buyer(v)
+    dt = time.perf_counter()-t
+    return {"events": events, "VL": VL, "VR": VR, "seconds": dt, "events_per_sec": events / dt,
+        "sellers": len(sellers), "buyers": len(buyers)}
+
+
+def scaling_exponents(results):
+    # Slope of log(seconds) against log(N) for every (CONNECT_PROB, initial fraction) series
+    series = {}
+    for r in results:
+        key = (r["CONNECT_PROB"], round(r["INITIAL_PARTICIPANT_NUM"] / r["N"], 6))
+        series.setdefault(key, []).append(r)
+
+    res = []
+    for (CONNECT_PROB, frac), rs in sorted(series.items()):
+        if len(rs) < 2:
+            continue
+        x = np.log([r["N"] for r in rs])
+        exps = {stage: float(np.polyfit(x, np.log([max(r["seconds"][stage], 1e-9) for r in rs]), 1)[0]) for stage in STAGES}
+        res.append({"CONNECT_PROB": CONNECT_PROB, "initial_frac": frac, "points": len(rs), "exponents": exps})
+    return res
+
+
+def revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)), stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def benchmark(Ns=NS, CONNECT_PROBS=CONNECT_PROBS, INITIAL_FRACS=INITIAL_FRACS, trials=3, seed=0, max_edges=5*10**7, out="bench.json", online_events=0):
+    ctx = get_context("spawn")
+    results = []
+    skipped = []
+    for N in Ns:
+        for CONNECT_PROB in CONNECT_PROBS:
+            nei = int(CONNECT_PROB*N//2)
+            for frac in INITIAL_FRACS:
+                point = (N, CONNECT_PROB, int(frac*N))
+                if nei < 1 or N*nei > max_edges: # empty or too large for this box
+                    skipped.append(point)
+                    continue
+                print(*point)
+                with ctx.Pool(1) as pool:
+                    results.append(pool.apply(run_point, point + (trials, seed)))
+
+    report = {
+        "revision": revision(),
+        "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "python": sys.version.split()[0],
+        "numpy": np.__version__,
+        "igraph": ig.__version__,
+        "machine": platform.machine(),
+        "results": results,
+        "skipped": skipped,
+        "scaling": scaling_exponents(results),
+        "online": run_online(online_events, seed=seed) if online_events > 0 else None,
+    }
+    with open(out, "w") as f:
+        json.dump(report, f, indent=1)
+    return report
+
+
+def compare(old_path, new_path):
+    # Print the per-stage speedup of new over old at every grid point both files share
+    with open(old_path) as f:
+        old = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+
+    key = lambda r: (r["N"], r["CONNECT_PROB"], r["INITIAL_PARTICIPANT_NUM"])
+    base = {key(r): r for r in old["results"]}
+    for r in new["results"]:
+        if key(r) in base:
+            o = base[key(r)]
+            print(*key(r), " ".join("{}={:.2f}x".format(stage, o["seconds"][stage] / max(r["seconds"][stage], 1e-9)) for stage in STAGES))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--N", type=int, nargs="+", default=NS)
+    parser.add_argument("--connect-prob", type=float, nargs="+", default=CONNECT_PROBS)
+    parser.add_argument("--initial-frac", type=float, nargs="+", default=INITIAL_FRACS)
+    parser.add_argument("--trials", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--max-edges", type=int, default=5*10**7)
+    parser.add_argument("--out", default="bench.json")
+    parser.add_argument("--online", type=int, default=0, metavar="EVENTS", help="also time OnlineDA on a stream of EVENTS events")
+    parser.add_argument("--compare", metavar="OLD_JSON")
+    args = parser.parse_args()
+
+    benchmark(args.N, args.connect_prob, args.initial_frac, args.trials, args.seed, args.max_edges, args.out, args.online)
+    if args.compare is not None:
+        compare(args.compare, args.out)
@@ -0,0 +1,39 @@
+import numpy as np
+
+
+class Diffusion:
+    '''
+    Frontier-based invitation over CSR neighbor arrays. visited is the bool
+    invited mask of the market and is updated in place; every round gathers
+    the neighbors of the whole frontier at once and hands the newly invited
+    sellers (ids < s) and buyers back as sorted id arrays.
+    '''
+    __slots__ = ("offsets", "indices", "visited", "s", "frontier_sizes", "invited_sizes", "edges")
+
+    def __init__(self, offsets, indices, visited, s):
+        self.offsets = offsets
+        self.indices = indices
+        self.visited = visited
+        self.s = s
+        self.frontier_sizes = [] # traders expanded per round
+        self.invited_sizes = [] # traders newly invited per round
+        self.edges = 0 # neighbor entries gathered so far
+
+    def expand(self, frontier):
+        frontier = np.asarray(frontier, dtype=np.int64)
+        start = self.offsets[frontier]
+        cnt = self.offsets[frontier+1] - start
+        total = int(cnt.sum())
+
+        # Position of every gathered neighbor: its row start plus its rank inside the row
+        pos = np.repeat(start - (np.cumsum(cnt) - cnt), cnt) + np.arange(total)
+        nbr = self.indices[pos]
+        new = np.unique(nbr[~self.visited[nbr]])
+        self.visited[new] = True
+
+        self.frontier_sizes.append(len(frontier))
+        self.invited_sizes.append(len(new))
+        self.edges += total
+
+        i = np.searchsorted(new, self.s)
+        return new[:i], new[i:]
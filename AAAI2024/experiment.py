@@ -1,176 +1,278 @@
 import igraph as ig
-from random import uniform, shuffle
-from random import randint as rd
+import os
+import random
+from random import Random
+from random import uniform
 from random import gauss as nm
-import heapq as hq
-from collections import deque
+from array import array
+from time import perf_counter
+from statistics import NormalDist
+from multiprocessing import Pool
+import numpy as np
 from matplotlib import pyplot as plt
+from graphs import csr_from_graph, GraphStore, csr_from_edge_file, load_traders
+from pools import RankPool
+from diffusion import Diffusion
+from baselines import rank_sellers, rank_buyers, crossing, trade_reduction, welfare, baselines_batch
+from stats import Stats, Welford, timed
+from records import point_path, save_point, load_point
+from mechanisms import MECHANISMS, DEFAULT, labels
+
+LARGE_N = 100000 # from this many traders on gen draws with NumPy, see DAs.gen
 
 class DAs:
+    '''
+    Market state is kept in typed arrays: int32 valuations, a bool invited
+    mask for the diffusion (the initial one is stored bit-packed), pools
+    over int32 sorted index arrays and int32 out lists. After solve() a
+    trader costs about 28 bytes next to the CSR arrays (8 bytes per trader
+    and 4 per neighbor entry); only those are kept of the generated graph.
+    Measured at 10^6 traders with one neighbor per side, gen peaks at about
+    150 bytes per trader of resident memory, most of it igraph's graph
+    until the CSR is built, so 10^7 traders take about 1.5 GB.
+    '''
+    __slots__ = ("stats", "out_seller", "out_buyer", "q_seller", "q_buyer", "p_s", "p_b", "sw_rounds",
+        "n", "vl", "vr", "val", "s", "b", "seller_total", "invited", "ori_invited",
+        "offsets", "indices", "labels", "diffusion", "cache")
+
     def __init__(self):
-        self.out_seller = deque()
-        self.out_buyer = deque()
+        self.stats = None # set to a Stats to record stage times and counters
+        self.reset()
+
+    def reset(self):
+        self.out_seller = array("i") # ids popped out of the market, the next frontier
+        self.out_buyer = array("i")
         self.q_seller = []
         self.q_buyer = []
         self.p_s = -1
         self.p_b = -1
+        self.sw_rounds = [] # welfare after every diffusion round
 
-    def gen(self, N, SL, SR, VL, VR, REWIRING_PROB, CONNECT_PROB, INITIAL_PARTICIPANT_NUM, opt):
-        # Setting Variant
-        self.n = N
-        self.val = [0 for i in range(self.n)]
-        self.invited = [False for i in range(self.n)]
-        self.ori_invited = [False for i in range(self.n)]
-        self.s = rd(SL, SR)
-        self.b = self.n - self.s
+    @timed("gen") # includes graph
+    def gen(self, N, SL, SR, VL, VR, REWIRING_PROB, CONNECT_PROB, INITIAL_PARTICIPANT_NUM, opt, rng=None, store=None, graph_seed=None):
+        # Use the global random stream unless the trial has its own
+        if rng is None:
+            rng = random
 
-        for i in range(self.n):
-            self.val[i] = rd(VL, VR)
+        # Setting Variant
+        s = rng.randint(SL, SR)
+        npr = None
+        if N >= LARGE_N: # no Python int per trader, the NumPy stream is seeded from the trial's
+            npr = np.random.default_rng(rng.getrandbits(128))
+            val = npr.integers(VL, VR, size=N, endpoint=True)
+        else:
+            val = np.array([rng.randint(VL, VR) for i in range(N)], dtype=np.int64)
 
         # Initialization of Graph
 
         # Randomly construct a graph
 
-        self.g = ig.GraphBase.Watts_Strogatz(dim=1, size=self.n, nei=int(CONNECT_PROB*self.n//2), p=REWIRING_PROB)
-        self.edges = self.g.get_adjacency()
+        self.gen_graph(N, REWIRING_PROB, CONNECT_PROB, store, graph_seed)
         
         # Randomly choose sellers and buyers
 
-        lis = [i for i in range(self.n)]
-        shuffle(lis)
-        for i in range(min(INITIAL_PARTICIPANT_NUM, self.n)):
-            self.ori_invited[lis[i]] = self.invited[lis[i]] = True
+        invited = np.zeros(N, dtype=bool)
+        if npr is not None:
+            invited[npr.choice(N, min(INITIAL_PARTICIPANT_NUM, N), replace=False)] = True
+        else:
+            lis = [i for i in range(N)]
+            rng.shuffle(lis)
+            for i in range(min(INITIAL_PARTICIPANT_NUM, N)):
+                invited[lis[i]] = True
+
+        self.load(val, s, invited, VL, VR)
+
+    @timed("graph")
+    def gen_graph(self, N, REWIRING_PROB, CONNECT_PROB, store=None, graph_seed=None):
+        nei = int(CONNECT_PROB*N//2)
+        if store is not None: # reuse the memory-mapped graph of this seed
+            self.offsets, self.indices = store.get(N, nei, REWIRING_PROB, graph_seed)
+            return
+
+        # Only the sparse neighbor lists are kept, the igraph object goes right away
+        g = ig.GraphBase.Watts_Strogatz(dim=1, size=N, nei=nei, p=REWIRING_PROB)
+        self.offsets, self.indices = csr_from_graph(g)
+
+    def load_network(self, edge_path, trader_path, INITIAL_PARTICIPANT_NUM=None, rng=None, chunk_edges=1 << 20):
+        '''
+        Load an external trader network: a streamed edge list plus a companion
+        column file of valuations, roles and optionally initial participants.
+        Without that column, INITIAL_PARTICIPANT_NUM random traders start.
+        '''
+        if rng is None:
+            rng = random
+
+        val, seller, invited = load_traders(trader_path)
+        if invited is None and INITIAL_PARTICIPANT_NUM is None:
+            raise ValueError("{} has no initial participant column, INITIAL_PARTICIPANT_NUM is required".format(trader_path))
+        n = len(val)
+
+        # Sellers must be the first s ids, so relabel them first while streaming the edges
+        self.labels = np.argsort(~seller, kind="stable") # original node id of each trader
+        rank = np.empty(n, dtype=np.int64)
+        rank[self.labels] = np.arange(n)
+
+        self.offsets, self.indices = csr_from_edge_file(edge_path, n, rank, chunk_edges)
+
+        if invited is None:
+            invited = np.zeros(n, dtype=bool)
+            invited[rng.sample(range(n), min(INITIAL_PARTICIPANT_NUM, n))] = True
+        else:
+            invited = invited[self.labels]
+
+        self.load(val[self.labels], int(seller.sum()), invited, int(val.min()), int(val.max()))
+
+    def load(self, val, s, invited, VL, VR):
+        # Trials must not leak reserve prices or queues into each other
+        self.reset()
+        self.cache = {} # rankings shared by the mechanisms of this instance
+
+        self.n = len(val)
+        self.vl, self.vr = VL, VR
+        val = np.asarray(val)
+        if len(val) > 0 and (val.min() < np.iinfo(np.int32).min or val.max() > np.iinfo(np.int32).max):
+            raise ValueError("valuations must fit in int32, got [{}, {}]".format(val.min(), val.max()))
+        self.val = val.astype(np.int32)
+        self.s = s
+        self.b = self.n - self.s
+        self.seller_total = int(self.val[:self.s].sum(dtype=np.int64))
+        self.invited = np.array(invited, dtype=bool) # grows as the diffusion invites traders
+        self.ori_invited = np.packbits(self.invited)
+
+    def initial(self):
+        # Initial participant mask, unpacked from its bit-packed copy
+        return np.unpackbits(self.ori_invited, count=self.n).view(bool)
+
+    def new_pools(self):
+        # Order-statistic pools keyed like the old heaps: sellers by -value, buyers by value
+        self.q_seller = RankPool(self.val[:self.s], -1) # max heap
+        self.q_buyer = RankPool(self.val[self.s:], 1, self.s) # min heap
 
     def align(self):
+        outs = len(self.out_seller) + len(self.out_buyer)
         while len(self.q_seller) != len(self.q_buyer):
             if len(self.q_seller) > len(self.q_buyer):
-                self.out_seller.append(hq.heappop(self.q_seller))
+                self.out_seller.append(self.q_seller.pop()[1])
             else:
-                self.out_buyer.append(hq.heappop(self.q_buyer))
-
-    def match(self):
-        if len(self.q_seller) != 0:
-            x, y = self.q_seller[0], self.q_buyer[0]
-            while -x[0] > y[0]:
-                self.out_seller.append(hq.heappop(self.q_seller))
-                self.out_buyer.append(hq.heappop(self.q_buyer))
-                if len(self.q_seller) == 0:
-                    break
-                x, y = self.q_seller[0], self.q_buyer[0]
+                self.out_buyer.append(self.q_buyer.pop()[1])
+        if self.stats is not None:
+            self.stats.count("pops", len(self.out_seller) + len(self.out_buyer) - outs)
+
+    def welfare(self):
+        # Sellers outside q_seller keep their items, q_buyer holds the buyers who get one.
+        # Seller keys are negative values, so the pool totals give this in O(1).
+        return self.seller_total + self.q_seller.total + self.q_buyer.total
 
+    @timed("review")
     def review(self):
         assert len(self.q_seller) == len(self.q_buyer)
-        sold = [False for u in range(self.n)]
-        sw = 0
-
-        for x in self.q_seller:
-            sold[x[1]] = True
-        for u in range(self.s):
-            if not sold[u]:
-                sw += self.val[u]
-        for x in self.q_buyer:
-            sw += x[0]
-
-        return sw
+        return self.welfare()
         
+    @timed("Optimal")
     def Optimal(self):
-        self.q_seller = []
-        for u in range(self.s):
-            hq.heappush(self.q_seller, (-self.val[u], u)) # max heap
-
-        # Use min heap to pop unmatchable buyers
-        self.q_buyer = []
-        for u in range(self.s, self.n):
-            hq.heappush(self.q_buyer, (self.val[u], u)) # min heap
-
-        self.align()
-        self.match()
-        return self.review()
+        # Efficient trades among all traders, on the ranking MTRAll shares
+        s_val, s_ids, b_val, b_ids = self.ranked(full=True)[:4]
+        return welfare(self.seller_total, s_val, b_val, crossing(s_val, b_val))
 
+    def ranked(self, full=False):
+        '''
+        Best-first sellers and buyers among the initial participants (or all
+        traders) with their trade reduction result (k, p_s, p_b). Computed
+        once per instance; the arrays are shared and read-only.
+        '''
+        key = "full" if full else "initial"
+        if key not in self.cache:
+            ids = np.arange(self.n, dtype=np.int32) if full else np.flatnonzero(self.initial()).astype(np.int32)
+            s_ids, b_ids = ids[ids < self.s], ids[ids >= self.s]
+            s_val, s_ids = rank_sellers(self.val[s_ids], s_ids)
+            b_val, b_ids = rank_buyers(self.val[b_ids], b_ids)
+
+            # Find the crossing point, then reduce one trade if p_0 does not fit
+            k, p_s, p_b = trade_reduction(s_val, b_val, crossing(s_val, b_val))
+            self.share(key, (s_val, s_ids, b_val, b_ids, k, p_s, p_b))
+        return self.cache[key]
+
+    def share(self, key, ranking):
+        # Cache a ranking for every mechanism of this instance, read-only so none can change it for the others
+        for arr in ranking[:4]:
+            arr.flags.writeable = False
+        self.cache[key] = ranking
+
+    @timed("MTRForInit")
     def MTRForInit(self):
-        # Use max heap to pop unmatchable sellers
-        self.q_seller = []
-        for u in range(self.s):
-            if self.invited[u]:
-                hq.heappush(self.q_seller, (-self.val[u], u)) # max heap
-
-        # Use min heap to pop unmatchable buyers
-        self.q_buyer = []
-        for u in range(self.s, self.n):
-            if self.invited[u]:
-                hq.heappush(self.q_buyer, (self.val[u], u)) # min heap
-
-        # Align sellers and buyers
-        self.align()
-        # Pop and store the unmatchbale sellers and buyers
-        self.match()
-        
-        # calculate p_0
-        if len(self.q_seller) != 0 and len(self.q_buyer) != 0:
-            flag = False
-            if len(self.out_seller) != 0 and len(self.out_buyer) != 0:
-                x, y = self.out_seller[len(self.out_seller)-1], self.out_buyer[len(self.out_buyer)-1]
-                p_0 = (x[0] + y[0]) / 2
-                if -self.q_seller[0][0] <= p_0 <= self.q_buyer[0][0]:
-                    flag = True # k pairs
-            if not flag: # k-1 pairs
-                self.out_seller.append(hq.heappop(self.q_seller))
-                self.out_buyer.append(hq.heappop(self.q_buyer))
-
-            self.p_s, self.p_b = -self.q_seller[0][0], self.q_buyer[0][0] # Initialize reserve price
-
-        return self.review()
-
+        s_val, s_ids, b_val, b_ids, k, p_s, p_b = self.ranked()
+        return welfare(self.seller_total, s_val, b_val, k)
+
+    def open_market(self, s_val, s_ids, b_val, b_ids, k, p_s, p_b):
+        if k != 0:
+            self.p_s, self.p_b = p_s, p_b # Initialize reserve price
+
+        # Matched traders stay in the pools, the unmatchable ones go out to invite
+        self.new_pools()
+        self.q_seller.extend(s_ids[:k]) # max heap
+        self.q_buyer.extend(b_ids[:k]) # min heap
+        self.out_seller.frombytes(s_ids[k:].astype(np.int32).tobytes())
+        self.out_buyer.frombytes(b_ids[k:].astype(np.int32).tobytes())
+        if self.stats is not None:
+            self.stats.count("pushes", 2*k)
+
+    @timed("TRP")
     def TRP(self):
+        outs = len(self.out_seller) + len(self.out_buyer)
+
         # Step 1 and Step 2
-        while len(self.q_seller) != 0 and -self.q_seller[0][0] > self.p_s:
-            self.out_seller.append(hq.heappop(self.q_seller))
-        while len(self.q_buyer) != 0 and self.q_buyer[0][0] < self.p_b:
-            self.out_buyer.append(hq.heappop(self.q_buyer))
+        while len(self.q_seller) != 0 and -self.q_seller.top()[0] > self.p_s:
+            self.out_seller.append(self.q_seller.pop()[1])
+        while len(self.q_buyer) != 0 and self.q_buyer.top()[0] < self.p_b:
+            self.out_buyer.append(self.q_buyer.pop()[1])
         q_s = len(self.q_seller)
         q_b = len(self.q_buyer)
+        if self.stats is not None:
+            self.stats.count("pops", len(self.out_seller) + len(self.out_buyer) - outs)
 
         # Step 3
         if q_s > q_b:
-            tmp_lis = []
-            for i in range(q_s-q_b-1): # get the q_b+1 th seller
-                tmp_lis.append(hq.heappop(self.q_seller))
-            self.p_s = -self.q_seller[0][0]
-
-            for i in range(q_s-q_b-1):
-                hq.heappush(self.q_seller, tmp_lis[i])
+            self.p_s = -self.q_seller.kth(q_s-q_b) # get the q_b+1 th seller
         elif q_s < q_b:
-            tmp_lis = []
-            for i in range(q_b-q_s-1): # get the q_s+1 th buyer
-                tmp_lis.append(hq.heappop(self.q_buyer))
-            self.p_b = self.q_buyer[0][0]
-
-            for i in range(q_b-q_s-1):
-                hq.heappush(self.q_buyer, tmp_lis[i])
-
-    def solve(self):
+            self.p_b = self.q_buyer.kth(q_b-q_s) # get the q_s+1 th buyer
+
+    @timed("invite")
+    def invite_round(self):
+        # Every trader popped out of the market this round forms the frontier
+        frontier = np.concatenate((np.frombuffer(self.out_seller, dtype=np.int32), np.frombuffer(self.out_buyer, dtype=np.int32)))
+        self.out_seller = array("i")
+        self.out_buyer = array("i")
+
+        edges = self.diffusion.edges
+        sel, buy = self.diffusion.expand(frontier)
+        self.q_seller.extend(sel) # max heap
+        self.q_buyer.extend(buy) # min heap
+        if self.stats is not None:
+            self.stats.count("edges", self.diffusion.edges - edges)
+            self.stats.count("pushes", len(sel) + len(buy))
+
+        return len(sel) + len(buy)
+
+    def solve(self, mechs=DEFAULT):
+        # Welfare of every registered mechanism in mechs on this instance
+        return tuple(MECHANISMS[name][1](self) for name in mechs)
+
+    @timed("DTR") # includes invite, TRP and review
+    def DTR(self):
         '''
-        Calculate optimal SW for reference
+        Stage 1: Do McAfee's Trade Reduction Mechanism on the initial traders.
+        The market restarts from a fresh copy of the initial mask, so other
+        mechanisms before or after this one see the same instance.
         '''
-        res0 = self.Optimal()
-
-        self.out_seller = deque()
-        self.out_buyer = deque()
+        self.reset()
+        self.invited = self.initial()
+        self.open_market(*self.ranked())
 
-        '''
-        Stage 1: Do McAfee's Trade Reduction Mechanism
-        '''
-    
-        res1 = self.MTRForInit()
         if self.p_s == -1 and self.p_b == -1: # If no trade in MTR
-            res_s = 1e18 # INF
-            res_b = -1
-            for u in range(self.s):
-                if invited[u]:
-                    res_s = min(res_s, self.val[u])
-            for u in range(self.s, self.n):
-                if invited[u]:
-                    res_b = max(res_b, self.val[u])
+            sel = self.val[:self.s][self.invited[:self.s]]
+            buy = self.val[self.s:][self.invited[self.s:]]
+            res_s = int(sel.min()) if sel.size else 10**18 # INF
+            res_b = int(buy.max()) if buy.size else -1
 
             self.p_s = min(res_s, res_b)
             self.p_b = max(res_s, res_b)
@@ -179,45 +281,111 @@ class DAs:
         Stage 2: Invite people, do TRP
         '''
 
+        self.diffusion = Diffusion(self.offsets, self.indices, self.invited, self.s)
+
         flag = 1
+        r = 0
         while flag:
             flag = 0
             # Inviting
-            while len(self.out_seller) != 0:
-                x = self.out_seller.popleft()
-                for v in range(self.n):
-                    if self.edges[x[1]][v] and not self.invited[v]:
-                        flag = 1 # mark that it is not empty
-                        self.invited[v] = True # mark v as invited
-                        if v < self.s:
-                            hq.heappush(self.q_seller, (-self.val[v], v)) # max heap
-                        else:
-                            hq.heappush(self.q_buyer, (self.val[v], v)) # min heap
-
-
-            while len(self.out_buyer) != 0:
-                x = self.out_buyer.popleft()
-                for v in range(self.n):
-                    if self.edges[x[1]][v] and not self.invited[v]:
-                        flag = 1 # mark that it is not empty
-                        self.invited[v] = True
-                        if v < self.s:
-                            hq.heappush(self.q_seller, (-self.val[v], v)) # max heap
-                        else:
-                            hq.heappush(self.q_buyer, (self.val[v], v)) # min heap
+            cnt = self.invite_round()
+            if cnt != 0:
+                flag = 1 # mark that it is not empty
+            if self.stats is not None:
+                self.stats.count("rounds")
+                self.stats.add_round(r, cnt)
+            r += 1
 
             # do TRP
             self.TRP()
+            self.sw_rounds.append(self.welfare())
 
         # Summarize the result
 
         self.align()
-        res2 = self.review()
-
-        return res0, res1, res2
+        return self.review()
 
 
-def experiment(VARL, VARR, VARSTEP, LOOP, opt):
+def run_trial(unit):
+    # One (VAR, trial) work unit with its own deterministic random stream
+    params, seed, graph_dir, graph_seed, profile, mechs = unit
+    rng = Random(seed)
+    ig.set_random_number_generator(rng) # Watts_Strogatz draws from igraph's generator
+    store = GraphStore(graph_dir) if graph_dir is not None else None
+    DA = DAs()
+    if profile:
+        DA.stats = Stats()
+    DA.gen(*params, rng=rng, store=store, graph_seed=graph_seed)
+    return [DA.solve(mechs)], DA.stats
+
+
+def gen_batch(B, N, SL, SR, VL, VR, INITIAL_PARTICIPANT_NUM, rng):
+    # Valuations, seller counts and initial participant masks of B instances as arrays
+    s = rng.integers(SL, SR, size=B, endpoint=True)
+    val = rng.integers(VL, VR, size=(B, N), endpoint=True)
+    invited = np.zeros((B, N), dtype=bool)
+    lis = np.argsort(rng.random((B, N)), axis=1)[:, :min(INITIAL_PARTICIPANT_NUM, N)]
+    np.put_along_axis(invited, lis, True, axis=1)
+    return val, s, invited
+
+
+def run_batch(unit):
+    # Optimal and MTR for the whole batch at once, the other mechanisms run per instance
+    params, entropy, B, graph_dir, graph_seeds, profile, mechs = unit
+    N, SL, SR, VL, VR, REWIRING_PROB, CONNECT_PROB, INITIAL_PARTICIPANT_NUM, opt = params
+    stats = Stats() if profile else None
+    t = perf_counter()
+    rng = np.random.default_rng(entropy)
+    val, s, invited = gen_batch(B, N, SL, SR, VL, VR, INITIAL_PARTICIPANT_NUM, rng)
+    if stats is not None:
+        stats.add_time("gen_batch", perf_counter()-t)
+        t = perf_counter()
+    res0, res1, (s_val, s_ids, s_cnt, b_val, b_ids, b_cnt, k, p_s, p_b) = baselines_batch(val, s, invited)
+    if stats is not None:
+        stats.add_time("baselines_batch", perf_counter()-t)
+
+    ig.set_random_number_generator(Random(int(rng.integers(2**62))))
+    store = GraphStore(graph_dir) if graph_dir is not None else None
+    DA = DAs()
+    DA.stats = stats
+    batched = {"Optimal": res0, "MTR": res1}
+    res = []
+    for i in range(B):
+        DA.gen_graph(N, REWIRING_PROB, CONNECT_PROB, store, graph_seeds[i])
+        DA.load(val[i], int(s[i]), invited[i], VL, VR)
+        DA.share("initial", (s_val[i, :s_cnt[i]], s_ids[i, :s_cnt[i]], b_val[i, :b_cnt[i]], b_ids[i, :b_cnt[i]], int(k[i]), int(p_s[i]), int(p_b[i])))
+        res.append(tuple(int(batched[name][i]) if name in batched else MECHANISMS[name][1](DA) for name in mechs))
+    return res, stats
+
+
+def point_units(params, VAR, start, count, seed, batch, graph_dir, profile, mechs):
+    # Work units of trials [start, start+count) of one sweep point.
+    # With a graph store, trial i draws the same graph seed at every sweep point.
+    units = []
+    if batch > 0:
+        for i in range(start, start+count, batch):
+            size = min(batch, start+count-i)
+            # default_rng only takes non-negative integers, so hash the unit like run_trial's string seed
+            entropy = Random("{}-{}-{}".format(seed, VAR, i)).getrandbits(128)
+            units.append((params, entropy, size, graph_dir, ["{}-{}".format(seed, i+j) for j in range(size)], profile, mechs))
+    else:
+        for i in range(start, start+count):
+            units.append((params, "{}-{}-{}".format(seed, VAR, i), graph_dir, "{}-{}".format(seed, i), profile, mechs))
+    return units
+
+
+def experiment(VARL, VARR, VARSTEP, LOOP, opt, workers=1, seed=0, batch=0, graph_dir=None, profile=False, tol=None, min_loop=100, check=100, conf=0.95, out_dir="sweep", mechs=DEFAULT):
+    '''
+    mechs names the registered mechanisms to evaluate on every instance;
+    all of them see the same trials, and welfare ratios are taken against
+    the first one.
+    With tol set, a sweep point stops once the confidence interval half-width
+    of every mechanism's ratio is at most tol (after at least min_loop trials,
+    checked every check trials), and LOOP becomes the maximum trial count.
+    Every finished point is saved as a record in out_dir (None turns this
+    off), so a crash only loses the point in progress and a rerun with the
+    same configuration skips the points already saved.
+    '''
     N = 1000
     SL = N//2
     SR = N//2
@@ -226,35 +394,103 @@ def experiment(VARL, VARR, VARSTEP, LOOP, opt):
     REWIRING_PROB = 0.3
     CONNECT_PROB = 0.3
     INITIAL_PARTICIPANT_NUM = 300
-    EXP_CNT = 3
-
-    DA = DAs()
+    EXP_CNT = len(mechs)
+    LABELS = labels(mechs)
 
+    # Enumerate the sweep points first, then spread (VAR, trial) units over the pool
     x = []
-    y = [[] for j in range(EXP_CNT)]
+    points = []
     VAR = VARL
     while VAR <= VARR:
-        print(VAR)
         if opt == 1:
             CONNECT_PROB = VAR/1000
         elif opt == 2:
             INITIAL_PARTICIPANT_NUM = VAR
-            
-        res = [0 for j in range(EXP_CNT)]
-        for i in range(LOOP):
-            DA.gen(N, SL, SR, VL, VR, REWIRING_PROB, CONNECT_PROB, INITIAL_PARTICIPANT_NUM, opt)
-            now = DA.solve()
-            for j in range(EXP_CNT):
-                res[j] += now[j]/now[0]
+
         x.append(VAR)
-        for j in range(EXP_CNT):
-            y[j].append(res[j]/LOOP)
+        points.append((N, SL, SR, VL, VR, REWIRING_PROB, CONNECT_PROB, INITIAL_PARTICIPANT_NUM, opt))
 
         if int(VARSTEP) == VARSTEP:
             VAR += VARSTEP
         else:
             VAR = int(VAR*VARSTEP)
 
+    # Points finished by an earlier run with the same configuration
+    configs = [{"params": list(params), "VAR": VAR, "LOOP": LOOP, "seed": seed, "batch": batch, "graph": graph_dir is not None,
+        "tol": tol, "min_loop": min_loop, "check": check, "conf": conf, "mechs": list(mechs)} for VAR, params in zip(x, points)]
+    done = {}
+    if out_dir is not None:
+        os.makedirs(out_dir, exist_ok=True)
+        for t, VAR in enumerate(x):
+            rec = load_point(point_path(out_dir, opt, VAR), configs[t])
+            if rec is not None:
+                done[t] = rec
+
+    run = run_batch if batch > 0 else run_trial
+    pool = Pool(workers) if workers > 1 else None
+    def run_all(units):
+        if pool is not None:
+            return pool.imap(run, units, chunksize=max(1, len(units)//(workers*16)))
+        return map(run, units)
+
+    if tol is None: # every point runs LOOP trials, so all units can be queued at once
+        results = run_all([u for t in range(len(x)) if t not in done for u in point_units(points[t], x[t], 0, LOOP, seed, batch, graph_dir, profile, mechs)])
+    z = NormalDist().inv_cdf((1+conf)/2)
+
+    # Reduce in (VAR, trial) order so the sums do not depend on the worker count
+    y = [[] for j in range(EXP_CNT)]
+    ci = [[] for j in range(EXP_CNT)]
+    trials = []
+    stats = []
+    try:
+        for t, VAR in enumerate(x):
+            print(VAR)
+            if t in done:
+                for j in range(EXP_CNT):
+                    y[j].append(float(done[t]["sums"][j]/done[t]["trials"]))
+                    ci[j].append(float(done[t]["ci"][j]))
+                trials.append(int(done[t]["trials"]))
+                stats.append(None)
+                continue
+
+            res = [0 for j in range(EXP_CNT)]
+            acc = [Welford() for j in range(EXP_CNT)]
+            point = Stats() if profile else None
+            n = 0
+            while n < LOOP:
+                if tol is None:
+                    count = LOOP
+                else: # sample in fixed rounds, so where a point stops does not depend on the workers
+                    count = min(max(min_loop-n, check), LOOP-n)
+                units = point_units(points[t], VAR, n, count, seed, batch, graph_dir, profile, mechs)
+                it = results if tol is None else run_all(units)
+                for u in range(len(units)):
+                    nows, unit_stats = next(it)
+                    for now in nows:
+                        for j in range(EXP_CNT):
+                            res[j] += now[j]/now[0]
+                            acc[j].add(now[j]/now[0])
+                    if point is not None:
+                        point.merge(unit_stats)
+                n += count
+
+                if tol is not None and max(acc[j].half_width(z) for j in range(EXP_CNT)) <= tol:
+                    break
+
+            for j in range(EXP_CNT):
+                y[j].append(res[j]/n)
+                ci[j].append(acc[j].half_width(z))
+            trials.append(n)
+            stats.append(point)
+
+            if out_dir is not None:
+                save_point(point_path(out_dir, opt, VAR), configs[t], VAR=VAR, trials=n, labels=LABELS, sums=res,
+                    mean=[a.mean for a in acc], m2=[a.m2 for a in acc], ci=[a.half_width(z) for a in acc])
+    finally:
+        if pool is not None:
+            pool.terminate()
+        ig.set_random_number_generator(random)
+
     '''
     labels = ["Optimal Social Welfare", "MTR for initial traders", "DTR Mechanism"]
     for j in range(EXP_CNT):
@@ -264,7 +500,10 @@ def experiment(VARL, VARR, VARSTEP, LOOP, opt):
     '''
 
     with open("data.out","a") as f:
-        f.write("opt={}\n".format(opt))
+        if tol is None:
+            f.write("opt={}\n".format(opt))
+        else:
+            f.write("opt={} tol={} conf={}\n".format(opt, tol, conf))
         for val in x:
             f.write("{} ".format(val))
         f.write('\n')
@@ -272,6 +511,23 @@ def experiment(VARL, VARR, VARSTEP, LOOP, opt):
             for val in y[j]:
                 f.write("{} ".format(val))
             f.write('\n')
+        if tol is not None: # achieved CI half-widths, then trials used per point
+            for j in range(EXP_CNT):
+                for val in ci[j]:
+                    f.write("{} ".format(val))
+                f.write('\n')
+            for val in trials:
+                f.write("{} ".format(val))
+            f.write('\n')
         f.write('\n')
 
+    if profile:
+        with open("stats.out","a") as f:
+            for VAR, n, point in zip(x, trials, stats):
+                if point is None: # restored from out_dir
+                    continue
+                f.write("opt={} VAR={} trials={}\n".format(opt, VAR, n))
+                point.write(f)
+                f.write('\n')
+
 # experiment(1, 100, 5, 1000, 1)
@@ -0,0 +1,172 @@
+import os
+import random
+from random import Random
+import shutil
+import tempfile
+import igraph as ig
+import numpy as np
+
+
+def csr_from_edges(n, src, dst):
+    # Build the symmetric CSR neighbor structure of an undirected graph
+    src = np.asarray(src, dtype=np.int64)
+    dst = np.asarray(dst, dtype=np.int64)
+    heads = np.concatenate((src, dst))
+    tails = np.concatenate((dst, src))
+
+    order = np.argsort(heads, kind="stable")
+    indices = tails[order].astype(np.int32)
+
+    offsets = np.zeros(n+1, dtype=np.int64)
+    np.cumsum(np.bincount(heads, minlength=n), out=offsets[1:])
+    return offsets, indices
+
+
+def csr_from_graph(g, list_edges=1 << 18, chunk_edges=1 << 16):
+    # get_edgelist builds a Python tuple per edge, so graphs of more than list_edges edges
+    # are streamed through a temporary edge file chunk_edges edges at a time instead
+    if g.ecount() <= list_edges:
+        edges = np.array(g.get_edgelist(), dtype=np.int64).reshape(-1, 2)
+        return csr_from_edges(g.vcount(), edges[:, 0], edges[:, 1])
+
+    fd, path = tempfile.mkstemp(suffix=".txt")
+    os.close(fd)
+    try:
+        g.write_edgelist(path)
+        return csr_from_edge_file(path, g.vcount(), chunk_edges=chunk_edges)
+    finally:
+        os.remove(path)
+
+
+class GraphStore:
+    '''
+    On-disk cache of Watts-Strogatz graphs keyed by (N, nei, p, seed).
+    Each graph is written once as offsets.npy/indices.npy and loaded back
+    memory-mapped, so repeated trials and sweep points share it zero-copy.
+    '''
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def path(self, N, nei, p, seed):
+        return os.path.join(self.root, "ws_{}_{}_{}_{}".format(N, nei, p, seed))
+
+    def get(self, N, nei, p, seed):
+        path = self.path(N, nei, p, seed)
+        if not os.path.exists(path):
+            self.write(path, N, nei, p, seed)
+        return load_csr(path)
+
+    def write(self, path, N, nei, p, seed):
+        # The graph depends only on its key, igraph goes back to the global stream afterwards
+        ig.set_random_number_generator(Random(seed))
+        try:
+            offsets, indices = csr_from_graph(ig.GraphBase.Watts_Strogatz(dim=1, size=N, nei=nei, p=p))
+        finally:
+            ig.set_random_number_generator(random)
+
+        # Write next to the target and rename, so concurrent workers never see half a graph
+        tmp = "{}.tmp{}".format(path, os.getpid())
+        save_csr(tmp, offsets, indices)
+        try:
+            os.rename(tmp, path)
+        except OSError: # another worker stored it first
+            shutil.rmtree(tmp)
+
+
+def save_csr(path, offsets, indices):
+    os.makedirs(path, exist_ok=True)
+    np.save(os.path.join(path, "offsets.npy"), offsets)
+    np.save(os.path.join(path, "indices.npy"), indices)
+
+
+def load_csr(path):
+    offsets = np.load(os.path.join(path, "offsets.npy"), mmap_mode="r")
+    indices = np.load(os.path.join(path, "indices.npy"), mmap_mode="r")
+    return offsets, indices
+
+
+def read_edge_chunks(path, chunk_edges=1 << 20):
+    '''
+    Yield (src, dst) arrays of at most about chunk_edges edges from an edge list.
+    .npy files hold an (E, 2) integer array, .bin files raw little-endian int32
+    pairs, anything else is text with one "u v" pair per line ('#'/'%' comments).
+    '''
+    if path.endswith(".npy") or path.endswith(".bin"):
+        if path.endswith(".npy"):
+            edges = np.load(path, mmap_mode="r")
+        else:
+            edges = np.memmap(path, dtype="<i4", mode="r").reshape(-1, 2)
+        for i in range(0, len(edges), chunk_edges):
+            chunk = np.asarray(edges[i:i+chunk_edges], dtype=np.int64)
+            yield chunk[:, 0], chunk[:, 1]
+        return
+
+    with open(path) as f:
+        while True:
+            lines = f.readlines(chunk_edges * 16) # size hint in bytes
+            if len(lines) == 0:
+                break
+            lines = [l for l in lines if l.strip() and l.lstrip()[0] not in "#%"]
+            if len(lines) != 0:
+                chunk = np.loadtxt(lines, dtype=np.int64, usecols=(0, 1), ndmin=2)
+                yield chunk[:, 0], chunk[:, 1]
+
+
+def csr_from_edge_file(path, n=None, rank=None, chunk_edges=1 << 20):
+    '''
+    Stream an edge list into CSR arrays in two passes: count degrees, then
+    scatter each chunk into place. Only the CSR arrays and one chunk are held
+    in memory. rank optionally relabels node u as rank[u]; self-loops are dropped.
+    '''
+    deg = np.zeros(n if n is not None else 0, dtype=np.int64)
+    for src, dst in read_edge_chunks(path, chunk_edges):
+        if len(src) == 0:
+            continue
+        top = max(int(src.max()), int(dst.max()))
+        if n is not None and (top >= n or min(int(src.min()), int(dst.min())) < 0):
+            raise ValueError("edge endpoint out of range [0, {})".format(n))
+        if top >= len(deg):
+            deg = np.concatenate((deg, np.zeros(top+1-len(deg), dtype=np.int64)))
+        keep = src != dst
+        deg += np.bincount(src[keep], minlength=len(deg))
+        deg += np.bincount(dst[keep], minlength=len(deg))
+    if rank is not None:
+        relabeled = np.zeros(len(deg), dtype=np.int64)
+        relabeled[rank[:len(deg)]] = deg
+        deg = relabeled
+
+    offsets = np.zeros(len(deg)+1, dtype=np.int64)
+    np.cumsum(deg, out=offsets[1:])
+    indices = np.empty(offsets[-1], dtype=np.int32)
+    cursor = offsets[:-1].copy()
+
+    for src, dst in read_edge_chunks(path, chunk_edges):
+        keep = src != dst
+        src, dst = src[keep], dst[keep]
+        if rank is not None:
+            src, dst = rank[src], rank[dst]
+        heads = np.concatenate((src, dst))
+        tails = np.concatenate((dst, src))
+        order = np.argsort(heads, kind="stable")
+        heads, tails = heads[order], tails[order]
+
+        # Each run of equal heads goes to the next free slots of that row
+        uniq, first, cnt = np.unique(heads, return_index=True, return_counts=True)
+        indices[cursor[heads] + np.arange(len(heads)) - np.repeat(first, cnt)] = tails
+        cursor[uniq] += cnt
+
+    return offsets, indices
+
+
+def load_traders(path):
+    '''
+    Read the companion column file of an external network: line u holds
+    "value role [initial]" for node u, with role 0 for sellers and 1 for
+    buyers, and an optional 0/1 initial participant flag.
+    '''
+    cols = np.loadtxt(path, dtype=np.int64, ndmin=2, comments=("#", "%"))
+    val = cols[:, 0]
+    seller = cols[:, 1] == 0
+    invited = cols[:, 2].astype(bool) if cols.shape[1] > 2 else None
+    return val, seller, invited
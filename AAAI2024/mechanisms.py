@@ -0,0 +1,45 @@
+from baselines import welfare
+
+'''
+Registry of the mechanisms DAs.solve evaluates. A mechanism is a function
+of a loaded DAs returning its social welfare. All mechanisms of a trial
+run on the same instance (graph, valuations, initial participants), and
+the best-first rankings they need are computed once per instance by
+DAs.ranked and shared read-only, so comparisons between them are paired.
+'''
+
+MECHANISMS = {} # name -> (label, function)
+DEFAULT = ("Optimal", "MTR", "DTR") # the first mechanism is the reference of the ratios
+
+
+def mechanism(name, label):
+    def wrap(f):
+        MECHANISMS[name] = (label, f)
+        return f
+    return wrap
+
+
+def labels(mechs):
+    return [MECHANISMS[name][0] for name in mechs]
+
+
+@mechanism("Optimal", "Optimal Social Welfare")
+def optimal_welfare(DA):
+    return DA.Optimal()
+
+
+@mechanism("MTR", "MTR for initial traders")
+def mtr_initial(DA):
+    return DA.MTRForInit()
+
+
+@mechanism("DTR", "DTR Mechanism")
+def dtr(DA):
+    return DA.DTR()
+
+
+@mechanism("MTRAll", "MTR for all traders")
+def mtr_all(DA):
+    # McAfee's trade reduction as if every trader had been invited
+    s_val, s_ids, b_val, b_ids, k, p_s, p_b = DA.ranked(full=True)
+    return welfare(DA.seller_total, s_val, b_val, k)
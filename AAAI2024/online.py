@@ -0,0 +1,79 @@
+from pools import ValueSet
+from baselines import trade_reduction
+
+
+class Ranked:
+    # Best-first view of a ValueSet, indexable like the rank_sellers/rank_buyers arrays
+    __slots__ = ("values", "low_first")
+
+    def __init__(self, values, low_first):
+        self.values = values
+        self.low_first = low_first
+
+    def __len__(self):
+        return len(self.values)
+
+    def __getitem__(self, i):
+        if self.low_first:
+            return self.values.kth(i+1)
+        return self.values.kth(len(self.values)-i)
+
+    def head_sum(self, k):
+        # Sum of the k best values
+        if self.low_first:
+            return self.values.low_sum(k)
+        return self.values.total - self.values.low_sum(len(self.values)-k)
+
+
+class OnlineDA:
+    '''
+    Streaming double auction. Sellers and buyers arrive and leave one at a
+    time; after every event the efficient crossing point k, the trade
+    reduction result (trades, p_s, p_b) and both welfares are up to date.
+    One arrival or departure moves k by at most one, so every event costs
+    O(log V) Fenwick queries.
+    '''
+    __slots__ = ("sellers", "buyers", "s_rank", "b_rank", "k", "trades", "p_s", "p_b", "sw", "sw_mtr")
+
+    def __init__(self, VL, VR):
+        self.sellers = ValueSet(VL, VR)
+        self.buyers = ValueSet(VL, VR)
+        self.s_rank = Ranked(self.sellers, True)
+        self.b_rank = Ranked(self.buyers, False)
+        self.k = 0
+        self.update()
+
+    def add_seller(self, v):
+        self.sellers.add(v)
+        self.update()
+
+    def remove_seller(self, v):
+        self.sellers.add(v, -1)
+        self.update()
+
+    def add_buyer(self, v):
+        self.buyers.add(v)
+        self.update()
+
+    def remove_buyer(self, v):
+        self.buyers.add(v, -1)
+        self.update()
+
+    def trades_at(self, k):
+        # Whether the k-th best seller and buyer can still trade
+        return self.s_rank[k-1] <= self.b_rank[k-1]
+
+    def welfare(self, k):
+        return self.sellers.total - self.s_rank.head_sum(k) + self.b_rank.head_sum(k)
+
+    def update(self):
+        m = min(len(self.sellers), len(self.buyers))
+        self.k = min(self.k, m)
+        while self.k > 0 and not self.trades_at(self.k):
+            self.k -= 1
+        while self.k < m and self.trades_at(self.k+1):
+            self.k += 1
+
+        self.trades, self.p_s, self.p_b = trade_reduction(self.s_rank, self.b_rank, self.k)
+        self.sw = self.welfare(self.k) # efficient welfare
+        self.sw_mtr = self.welfare(self.trades) # welfare under trade reduction
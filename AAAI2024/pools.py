@@ -0,0 +1,167 @@
+from array import array
+import numpy as np
+
+
+class Fenwick:
+    __slots__ = ("n", "tree", "step", "typecode")
+
+    def __init__(self, n, typecode=None):
+        # With a typecode the tree is a compact array.array instead of a list of ints
+        self.n = n
+        self.typecode = typecode
+        if typecode is None:
+            self.tree = [0 for i in range(n+1)]
+        else:
+            self.tree = array(typecode, bytes(array(typecode).itemsize*(n+1)))
+        self.step = 1 << (n.bit_length()-1) if n > 0 else 0
+
+    def add(self, i, d):
+        i += 1
+        while i <= self.n:
+            self.tree[i] += d
+            i += i & -i
+
+    def prefix(self, i):
+        # Sum of the first i buckets
+        res = 0
+        while i > 0:
+            res += self.tree[i]
+            i -= i & -i
+        return res
+
+    def search(self, k):
+        # Smallest bucket whose prefix sum reaches k
+        pos = 0
+        bit = self.step
+        while bit:
+            nxt = pos + bit
+            if nxt <= self.n and self.tree[nxt] < k:
+                pos = nxt
+                k -= self.tree[nxt]
+            bit >>= 1
+        return pos
+
+    def build(self, counts):
+        # Linear-time rebuild from per-bucket counts: node i sums the i & -i buckets ending at i
+        pre = np.concatenate(([0], np.cumsum(counts, dtype=np.int64)))
+        i = np.arange(1, self.n+1)
+        tree = np.concatenate(([0], pre[i] - pre[i - (i & -i)]))
+        if self.typecode is None:
+            self.tree = tree.tolist()
+        else:
+            self.tree = array(self.typecode, tree.astype(self.typecode).tobytes())
+
+
+class RankPool:
+    '''
+    Min-ordered pool over the traders base .. base+len(val)-1 with keys
+    sign*val. They are sorted by (key, id) once up front, so the pool pops
+    in the same order as a heap of (key, id) tuples while its state is a
+    membership mask and an int32 Fenwick tree over the sorted positions,
+    about 13 bytes per trader. k-th smallest key queries take O(log n) and
+    the running sum of the keys in the pool is kept in total.
+    '''
+    __slots__ = ("val", "sign", "base", "order", "rank", "member", "cnt", "size", "total")
+
+    def __init__(self, val, sign, base=0):
+        n = len(val)
+        self.val = val
+        self.sign = sign
+        self.base = base
+        self.order = np.argsort(sign*val, kind="stable").astype(np.int32) # position -> id-base
+        self.rank = np.empty(n, dtype=np.int32) # id-base -> position
+        self.rank[self.order] = np.arange(n, dtype=np.int32)
+        self.member = np.zeros(n, dtype=bool)
+        self.cnt = Fenwick(n, "i")
+        self.size = 0
+        self.total = 0
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        for pos in np.flatnonzero(self.member).tolist():
+            yield self.key(pos), int(self.order[pos]) + self.base
+
+    def key(self, pos):
+        return self.sign * int(self.val[self.order[pos]])
+
+    def push(self, u):
+        pos = int(self.rank[u-self.base])
+        self.member[pos] = True
+        self.cnt.add(pos, 1)
+        self.size += 1
+        self.total += self.key(pos)
+
+    def extend(self, ids):
+        ids = np.asarray(ids, dtype=np.int64)
+        if len(ids) * self.cnt.step.bit_length() <= self.cnt.n:
+            for u in ids.tolist():
+                self.push(u)
+            return
+
+        # Large batches: mark the positions and rebuild the tree once
+        self.member[self.rank[ids-self.base]] = True
+        self.cnt.build(self.member)
+        self.size += len(ids)
+        self.total += self.sign * int(self.val[ids-self.base].sum(dtype=np.int64))
+
+    def kth(self, k):
+        # Key of the k-th smallest item (1-based)
+        return self.key(self.cnt.search(k))
+
+    def top(self):
+        pos = self.cnt.search(1)
+        return self.key(pos), int(self.order[pos]) + self.base
+
+    def pop(self):
+        pos = self.cnt.search(1)
+        key = self.key(pos)
+        self.member[pos] = False
+        self.cnt.add(pos, -1)
+        self.size -= 1
+        self.total -= key
+        return key, int(self.order[pos]) + self.base
+
+
+class ValueSet:
+    '''
+    Multiset of integer values in [lo, hi] with Fenwick trees over the value
+    buckets for counts and sums: k-th smallest value and the sum of the k
+    smallest values both take O(log V).
+    '''
+    __slots__ = ("lo", "hi", "cnt", "sum", "mult", "size", "total")
+
+    def __init__(self, lo, hi):
+        self.lo = lo
+        self.hi = hi
+        self.cnt = Fenwick(hi-lo+1)
+        self.sum = Fenwick(hi-lo+1)
+        self.mult = [0 for i in range(hi-lo+1)]
+        self.size = 0
+        self.total = 0
+
+    def __len__(self):
+        return self.size
+
+    def add(self, v, d=1):
+        if not self.lo <= v <= self.hi:
+            raise ValueError("value {} out of range [{}, {}]".format(v, self.lo, self.hi))
+        if self.mult[v-self.lo] + d < 0:
+            raise ValueError("value {} is not in the set".format(v))
+        self.mult[v-self.lo] += d
+        self.cnt.add(v-self.lo, d)
+        self.sum.add(v-self.lo, d*v)
+        self.size += d
+        self.total += d*v
+
+    def kth(self, k):
+        # k-th smallest value (1-based)
+        return self.cnt.search(k) + self.lo
+
+    def low_sum(self, k):
+        # Sum of the k smallest values
+        if k == 0:
+            return 0
+        i = self.cnt.search(k)
+        return self.sum.prefix(i) + (k - self.cnt.prefix(i)) * (i + self.lo)
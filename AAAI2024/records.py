@@ -0,0 +1,53 @@
+import json
+import os
+import numpy as np
+
+'''
+Sweep results as one .npz record per sweep point. A record carries the
+full configuration it was computed with, the per-mechanism sums of the
+welfare ratios and the running variance state, so an interrupted sweep can
+skip finished points and the visualizer can read them without parsing text.
+'''
+
+PARAM_NAMES = ["N", "SL", "SR", "VL", "VR", "REWIRING_PROB", "CONNECT_PROB", "INITIAL_PARTICIPANT_NUM", "opt"]
+
+
+def point_path(out_dir, opt, VAR):
+    return os.path.join(out_dir, "opt{}_VAR{}.npz".format(opt, VAR))
+
+
+def save_point(path, config, **arrays):
+    # Write to a temporary file first, so a crash never leaves half a record behind
+    fields = {name: np.asarray(config["params"][i]) for i, name in enumerate(PARAM_NAMES)}
+    fields.update({name: np.asarray(val) for name, val in arrays.items()})
+    tmp = path[:-len(".npz")] + ".tmp.npz"
+    np.savez(tmp, config=np.array(json.dumps(config, sort_keys=True)), **fields)
+    os.replace(tmp, path)
+
+
+def read_point(path):
+    # All arrays of the record at path, read at once so the file is closed again
+    with np.load(path) as f:
+        return {name: f[name] for name in f.files}
+
+
+def load_point(path, config=None):
+    # The record at path, or None if it is missing or was made with another configuration
+    if not os.path.exists(path):
+        return None
+    rec = read_point(path)
+    if config is not None and str(rec["config"]) != json.dumps(config, sort_keys=True):
+        return None
+    return rec
+
+
+def load_points(out_dir, opt=None):
+    # Records of a sweep directory ordered by VAR, only those of opt if it is given
+    recs = []
+    for name in os.listdir(out_dir):
+        if name.endswith(".npz") and not name.endswith(".tmp.npz"):
+            rec = read_point(os.path.join(out_dir, name))
+            if opt is None or int(rec["opt"]) == opt:
+                recs.append(rec)
+    recs.sort(key=lambda rec: float(rec["VAR"]))
+    return recs
@@ -0,0 +1,77 @@
+from functools import wraps
+from math import sqrt
+from time import perf_counter
+
+
+class Stats:
+    '''
+    Wall time per stage and event counters of DAs runs. DAs only touches it
+    when its stats attribute is set, so disabled runs pay one None check per
+    timed call.
+    '''
+    def __init__(self):
+        self.times = {}
+        self.counts = {}
+        self.invited_per_round = [] # summed over trials
+
+    def add_time(self, stage, dt):
+        self.times[stage] = self.times.get(stage, 0) + dt
+
+    def count(self, name, d=1):
+        self.counts[name] = self.counts.get(name, 0) + d
+
+    def add_round(self, r, invited):
+        if r >= len(self.invited_per_round):
+            self.invited_per_round.extend([0 for i in range(r+1-len(self.invited_per_round))])
+        self.invited_per_round[r] += invited
+
+    def merge(self, other):
+        for stage, dt in other.times.items():
+            self.add_time(stage, dt)
+        for name, d in other.counts.items():
+            self.count(name, d)
+        for r, invited in enumerate(other.invited_per_round):
+            self.add_round(r, invited)
+
+    def write(self, f):
+        for stage, dt in self.times.items():
+            f.write("time {} {}\n".format(stage, dt))
+        for name, d in self.counts.items():
+            f.write("count {} {}\n".format(name, d))
+        f.write("invited_per_round {}\n".format(" ".join(map(str, self.invited_per_round))))
+
+
+def timed(stage):
+    # Record the wall time of a DAs method under stage when stats are enabled
+    def wrap(f):
+        @wraps(f)
+        def g(self, *args, **kwargs):
+            if self.stats is None:
+                return f(self, *args, **kwargs)
+            t = perf_counter()
+            res = f(self, *args, **kwargs)
+            self.stats.add_time(stage, perf_counter()-t)
+            return res
+        return g
+    return wrap
+
+
+class Welford:
+    # Running mean and sample variance of a stream of trial results
+    def __init__(self):
+        self.n = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+
+    def add(self, x):
+        self.n += 1
+        d = x - self.mean
+        self.mean += d / self.n
+        self.m2 += d * (x - self.mean)
+
+    def var(self):
+        return self.m2 / (self.n-1) if self.n > 1 else float("inf")
+
+    def half_width(self, z):
+        # Normal-approximation confidence interval half-width of the mean
+        return z * sqrt(self.var() / self.n) if self.n > 1 else float("inf")
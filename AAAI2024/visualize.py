@@ -2,26 +2,49 @@ from matplotlib import pyplot as plt
 import seaborn as sns
 import numpy as np
 import pandas as pd
+import os
+import sys
+from records import load_points
+from mechanisms import DEFAULT, labels as mech_labels
 plt.style.use('ggplot')
 sns.set_style('whitegrid')
 
-with open("data.out","r") as f:
-    s_lis = f.readlines()
-    
+# Plots the |N_0| sweep (opt=2) from the records experiment() writes, in the
+# directory given as the first argument ("sweep" by default). Without opt=2
+# records there it falls back to the last opt=2 block of data.out.
+out_dir = sys.argv[1] if len(sys.argv) > 1 else "sweep"
+recs = load_points(out_dir, opt=2) if os.path.isdir(out_dir) else []
+if len(recs) > 0:
+    x = [float(rec["VAR"]) for rec in recs]
+    labels = list(recs[0]["labels"])
+    ratios = np.array([rec["sums"] / rec["trials"] for rec in recs])
+else:
+    if not os.path.exists("data.out"):
+        sys.exit("no opt=2 records in {} and no data.out".format(out_dir))
+    with open("data.out","r") as f:
+        blocks = [b.splitlines() for b in f.read().split("\n\n") if b.startswith("opt=2")]
+    if len(blocks) == 0:
+        sys.exit("no opt=2 records in {} and no opt=2 sweep in data.out".format(out_dir))
+    # data.out has no labels, its rows follow the default mechanisms
+    s_lis = blocks[-1]
     x = list(map(float, s_lis[1].split()))
-    print(x)
-    df = pd.DataFrame(data=np.array([list(map(float, s_lis[i].split())) for i in range(2, 5)]).T, index=x, columns=["DTR", "Optimal Social Welfare", "MTR for initial traders"])
-    print(df)
-    colors = ["tomato red","dodger blue","royal blue"]
-    sns.lineplot(data=df, palette=sns.xkcd_palette(colors), linewidth=3)
+    labels = mech_labels(DEFAULT)
+    ratios = np.array([list(map(float, s_lis[i].split())) for i in range(2, 2+len(DEFAULT))]).T
 
-    ax = plt.gca()
-    lines = ax.get_lines()
-    lines[0].set_linestyle('-')
-    lines[1].set_linestyle('--')
-    lines[2].set_linestyle('--')
-    legend_handles, legend_labels = plt.gca().get_legend_handles_labels()
-    plt.xlabel("|N_0|",fontsize=14)
-    plt.ylabel("Ratio",fontsize=14)
-    plt.legend(prop={"size": 14})
-    plt.show()
+print(x)
+columns = ["DTR Mechanism", "Optimal Social Welfare", "MTR for initial traders"]
+df = pd.DataFrame(data=ratios[:, [labels.index(c) for c in columns]], index=x, columns=["DTR", "Optimal Social Welfare", "MTR for initial traders"])
+print(df)
+colors = ["tomato red","dodger blue","royal blue"]
+sns.lineplot(data=df, palette=sns.xkcd_palette(colors), linewidth=3)
+
+ax = plt.gca()
+lines = ax.get_lines()
+lines[0].set_linestyle('-')
+lines[1].set_linestyle('--')
+lines[2].set_linestyle('--')
+legend_handles, legend_labels = plt.gca().get_legend_handles_labels()
+plt.xlabel("|N_0|",fontsize=14)
+plt.ylabel("Ratio",fontsize=14)
+plt.legend(prop={"size": 14})
+plt.show()
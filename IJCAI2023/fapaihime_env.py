@@ -1,3 +1,4 @@
+import threading
 import numpy as np
 import gymnasium as gym
 from gymnasium import spaces
@@ -6,7 +7,8 @@ from fapaihime.allkeys import *
 from fapaihime.games.ruler import Ruler
 from agents.random_agent import RandomAgent
 from fapaihime.AssertHu import AssertHuForTrain, AssertShanten
-from copy import deepcopy
+from shanten_cache import ShantenCache
+from hand_shape import complete
 
 map_fan, rev_map_fan, map_34, rev_map_34, map_action, rev_map_action = get_keys()
 
@@ -21,8 +23,272 @@ rev_new_action_map = {
     7: "CHI"
 }
 
+# Compact actions: action code = action_type * 34 + tile, -1 for no action yet
+N_ACTIONS = 8 * 34
+ACTION_TYPES = np.eye(8, dtype=bool) # one-hot action type rows for the Ruler
+ACTION_TYPES.flags.writeable = False
+
+# Decision points for legal_actions: own turn after a draw, own turn right after a claim, someone else's discard
+TURN, CLAIMED, DISCARD = range(3)
+TILES = np.arange(34)
+CHI_MIDDLE = (TILES < 27) & (TILES % 9 >= 1) & (TILES % 9 <= 7) # suited tiles that can be the middle of a chi
+
+# Game scalars, stored in the arena next to the arrays
+WHO_AM_I, WIND, DEALER, MOUNTAIN_PTR, TIME_IDX, LAST_TILE, TERMINATED = range(7)
+
+FIELDS = [
+    # name, dtype, shape; 8-byte fields first so every view stays aligned
+    ("time_feature", np.int64, (136,)),
+    ("mountain", np.int64, (136,)),
+    ("win_tiles", np.int64, (4,)),
+    ("win_types", np.int64, (4,)),
+    ("scalars", np.int64, (7,)),
+    ("other_action", np.int64, (4,)), # last action code of every player
+
+    ("table_played_feature", bool, (136,)),
+    ("table_who_feature", bool, (4, 136)),
+    ("table_whos", bool, (4, 136)),
+    ("draw_tile", bool, (34,)),
+    ("other_new_played_tile", bool, (34,)),
+    ("who_is_play", bool, (4,)),
+
+    ("opponent_draw_tiles", bool, (4, 34)),
+
+    # Hands and melds: 136-bit masks packed in the rows of MASK_ROWS
+    ("mask_bits", np.uint8, (20, 17)),
+
+    # Shanten cache key: hand tile counts, then pengs, gangs and chis per tile
+    ("hand_counts", np.int8, (34,)),
+    ("meld_counts", np.int8, (3, 34)),
+    ("opponent_hand_counts", np.int8, (4, 34)),
+    ("opponent_meld_counts", np.int8, (4, 3, 34)),
+
+    ("legal_actions", bool, (8, 34)),
+    ("opponent_legal_actions", bool, (4, 8, 34))
+]
+
+
+def _layout(fields):
+    # Byte offset of every field in the arena of one game, and the arena size
+    layout = {}
+    nbytes = 0
+    for name, dtype, shape in fields:
+        dtype = np.dtype(dtype)
+        nbytes += -nbytes % dtype.itemsize
+        layout[name] = (nbytes, dtype, shape)
+        nbytes += dtype.itemsize * int(np.prod(shape))
+    return layout, nbytes + (-nbytes % 8)
+
+
+LAYOUT, NBYTES = _layout(FIELDS)
+
+# Row of every 136-wide hand and meld mask in mask_bits; the opponent masks take a row per player
+MASK_ROWS = {
+    "hand_feature": 0,
+    "is_peng": 1,
+    "is_gang": 2,
+    "is_chi": 3,
+    "opponent_hand_features": slice(4, 8),
+    "opponent_is_pengs": slice(8, 12),
+    "opponent_is_gangs": slice(12, 16),
+    "opponent_is_chis": slice(16, 20)
+}
+SHANTEN_CACHE = ShantenCache() # shared by every env of the process
+SHAPE_CACHE = ShantenCache() # winning-shape flags of the legal masks, under the 34 hand counts
+_LOCAL = threading.local()
+
+
+def views(arena):
+    '''
+    Typed views of every field of a uint8 arena of shape (NBYTES,) for one
+    game, or (K, NBYTES) for K stacked games, which gives (K, 136),
+    (K, 4, 136), ... views. Writing through a view writes the arena.
+    '''
+    lead = arena.shape[:-1]
+    res = {}
+    for name, (off, dtype, shape) in LAYOUT.items():
+        res[name] = arena[..., off:off + dtype.itemsize * int(np.prod(shape))].view(dtype).reshape(lead + shape)
+    return res
+
+
+# Bits of every byte value, most significant first as np.unpackbits gives them
+BITS = np.unpackbits(np.arange(256, dtype=np.uint8)[:, None], axis=1).view(bool)
+BITS.flags.writeable = False
+
+
+def unpack(bits, name):
+    # 136-wide boolean masks of name from packed mask_bits of shape (20, 17) or (K, 20, 17)
+    return np.unpackbits(bits[..., MASK_ROWS[name], :], axis=-1, count=136).view(bool)
+
+
+def _scratch():
+    # Unpacked rows of mask_bits that Ruler calls work on: one buffer per thread, shared by every env it steps
+    if not hasattr(_LOCAL, "masks"):
+        _LOCAL.masks = np.zeros((20, 136), dtype=bool)
+    return _LOCAL.masks
+
+
+def snapshot_buffer(n):
+    # Preallocated rows for n game snapshots, e.g. the nodes of a search tree
+    return np.empty((n, NBYTES), dtype=np.uint8)
+
+
+def deal(mountain, mask_bits, who_am_i, rows=None):
+    '''
+    Deal the first 52 tiles of K shuffled mountains of shape (K, 136) at once
+    into the packed hands of the given rows of mask_bits (all K rows by
+    default). The own hand takes the first 13 tiles and player i != who_am_i
+    takes tiles 13*i .. 13*i+12.
+    '''
+    if rows is None:
+        rows = np.arange(len(mountain))
+    K = len(mountain)
+    hands = mountain[:, :52].reshape(-1, 4, 13)
+    masks = np.zeros((K, 5, 136), dtype=bool) # own hand, then the opponent hands
+    masks[np.arange(K)[:, None], 0, hands[:, 0]] = 1
+    masks[np.arange(K)[:, None, None], 1 + np.arange(4)[:, None], hands] = 1
+    masks[np.arange(K), 1 + who_am_i] = 0
+    masks = np.packbits(masks, axis=-1)
+    mask_bits[rows, 0] = masks[:, 0]
+    mask_bits[rows, 4:8] = masks[:, 1:]
+
+
+def encode(action):
+    # Action code of a one-hot Dict action; codes pass through
+    if isinstance(action, dict):
+        return int(np.argmax(action["action_type_output"])) * 34 + int(np.argmax(action["my_played_output"]))
+    return int(action)
+
+
+def encode_batch(actions):
+    # Action codes of a batch: a Dict of stacked one-hot arrays, or codes already
+    if isinstance(actions, dict):
+        return np.argmax(actions["action_type_output"], axis=1) * 34 + np.argmax(actions["my_played_output"], axis=1)
+    return np.asarray(actions, dtype=np.int64)
+
+
+def to_dict(code):
+    # One-hot Dict form of an action code; PASS carries no tile and -1 is all zeros
+    action_output = np.zeros(8, dtype=bool)
+    tile_output = np.zeros(34, dtype=bool)
+    if code >= 0:
+        action_output[code // 34] = 1
+        if code >= 34:
+            tile_output[code % 34] = 1
+    return {"action_type_output": action_output, "my_played_output": tile_output}
+
+
+def decide(agents, obs, pre_actions):
+    '''
+    Action codes of agents[i] for obs[i] and its previous action code
+    pre_actions[i]. Agents that have a step_batch(list_of_obs,
+    list_of_pre_actions) method get all of their pending decisions in one
+    call; the others are asked one by one with step. Agents with int_actions
+    set take and return action codes, the others the one-hot Dict form.
+    '''
+    res = [None for i in range(len(agents))]
+    batches = {}
+    for i, agent in enumerate(agents):
+        if hasattr(agent, "step_batch"):
+            batches.setdefault(id(agent), []).append(i)
+        elif getattr(agent, "int_actions", False):
+            res[i] = int(agent.step(obs[i], pre_actions[i]))
+        else:
+            res[i] = encode(agent.step(obs[i], to_dict(pre_actions[i])))
+    for idx in batches.values():
+        agent = agents[idx[0]]
+        if getattr(agent, "int_actions", False):
+            actions = agent.step_batch([obs[i] for i in idx], [pre_actions[i] for i in idx])
+        else:
+            actions = agent.step_batch([obs[i] for i in idx], [to_dict(pre_actions[i]) for i in idx])
+        for i, action in zip(idx, actions):
+            res[i] = encode(action)
+    return res
+
+
+def winning_shape(counts, cache=None):
+    # complete(counts), memoized in cache (e.g. SHAPE_CACHE) under the 34 counts
+    if cache is None:
+        return complete(counts)
+    return cache.get(counts.tobytes(), complete, counts)
+
+
+def legal_actions(out, counts, pengs, tile, phase, chi=False, cache=None):
+    '''
+    Write the legal (action type, tile) pairs of a player into out of shape
+    (8, 34), from its 34 hand tile counts and per-tile peng counts. On its
+    own turn it may play any tile it holds or declare hu on tile (the one it
+    drew), and after a draw also kong four of a kind (ANGANG) or add to a
+    peng (BUGANG). On someone else's discard tile it may pass, hu, peng or
+    kong it, and chi it if chi is set; CHI is indexed by the middle tile.
+    Hu is only offered when the hand (with tile, on a discard) has a winning
+    shape; whether it reaches 8 fan is left to scoring. Nothing is allocated
+    beyond the cache key, counts is briefly changed in place and restored.
+    '''
+    out[:] = 0
+    if phase == DISCARD:
+        out[0, 0] = 1
+        counts[tile] += 1 # the hand with the discard, put back right after
+        out[2, tile] = winning_shape(counts, cache)
+        counts[tile] -= 1
+        out[3, tile] = counts[tile] >= 2
+        out[4, tile] = counts[tile] >= 3
+        if chi:
+            # Middle tiles m next to tile whose chi m-1, m, m+1 is complete with the discard
+            for m in (tile - 1, tile, tile + 1):
+                if 0 <= m < 34 and CHI_MIDDLE[m] and all(t == tile or counts[t] > 0 for t in (m - 1, m, m + 1)):
+                    out[7, m] = 1
+        return
+
+    np.greater(counts, 0, out=out[1])
+    out[2, tile] = winning_shape(counts, cache)
+    if phase == TURN:
+        np.equal(counts, 4, out=out[5])
+        np.logical_and(counts, pengs, out=out[6])
+
+
+def legal_actions_batch(out, counts, pengs, tile, phase, chi, cache=None):
+    '''
+    legal_actions for K stacked players at once: out is (K, 8, 34), counts
+    and pengs (K, 34), and tile, phase and chi hold one entry per row.
+    '''
+    K = len(counts)
+    rows = np.arange(K)
+    out[:] = 0
+    discard = phase == DISCARD
+    hand = counts.copy()
+    hand[rows[discard], tile[discard]] += 1
+    out[rows, 2, tile] = [winning_shape(h, cache) for h in hand]
+
+    d = rows[discard]
+    out[d, 0, 0] = 1
+    out[d, 3, tile[d]] = counts[d, tile[d]] >= 2
+    out[d, 4, tile[d]] = counts[d, tile[d]] >= 3
+    c = d[chi[d]]
+    have = counts[c] > 0
+    have[np.arange(len(c)), tile[c]] = True
+    lo = np.pad(have[:, :-1], ((0, 0), (1, 0)))
+    hi = np.pad(have[:, 1:], ((0, 0), (0, 1)))
+    out[c, 7] = CHI_MIDDLE & (np.abs(TILES - tile[c, None]) <= 1) & lo & have & hi
+
+    t = rows[~discard]
+    out[t, 1] = counts[t] > 0
+    t = rows[phase == TURN]
+    out[t, 5] = counts[t] == 4
+    out[t, 6] = (counts[t] > 0) & (pengs[t] > 0)
+
+
+def _scalar(i, cast=int):
+    return property(lambda self: cast(self.scalars[i]), lambda self, v: self.scalars.__setitem__(i, v))
+
+
+def _mask(name):
+    # Read-only 136-wide masks of name, unpacked from this game's mask_bits on every access
+    return property(lambda self: self._masks(MASK_ROWS[name]))
+
+
 class FapaiHimeEnv(gym.Env):
-    def __init__(self, other_agents = [RandomAgent() for i in range(4)]):
+    def __init__(self, other_agents = [RandomAgent() for i in range(4)], shanten_cache = SHANTEN_CACHE, shape_cache = SHAPE_CACHE):
         self.observation_space = spaces.Dict({
             "hand_feature": MultiBinary(136),
             "table_played_feature": MultiBinary(136),
@@ -37,6 +303,7 @@ class FapaiHimeEnv(gym.Env):
             "draw_tile": MultiBinary(34),
             "other_new_played_tile": MultiBinary(34),
             "who_is_play": MultiBinary(4),
+            "legal_actions": MultiBinary([8, 34]),
                 
             "who_am_i": Discrete(4),
             "wind": Discrete(4),
@@ -48,124 +315,218 @@ class FapaiHimeEnv(gym.Env):
             "my_played_output": MultiBinary(34),
             "action_type_output": MultiBinary(8)
         })
+        self.action_code_space = Discrete(N_ACTIONS) # step also takes action_type * 34 + tile
 
         self.other_agents = other_agents
         self.ruler = Ruler()
-
+        self.shanten_cache = shanten_cache
+        self.shape_cache = shape_cache # kept apart so shanten_cache.stats() only count shanten lookups
+        self._hand_row = 0 # row of mask_bits that hand_feature reads, see _get_payoff
+        self.bind(np.zeros(NBYTES, dtype=np.uint8))
         self.wind = -1
         self.dealer = -1 
 
-
         self.terminated = False
 
-    def _zero(self):
+    who_am_i = _scalar(WHO_AM_I)
+    wind = _scalar(WIND)
+    dealer = _scalar(DEALER)
+    mountain_ptr = _scalar(MOUNTAIN_PTR)
+    time_idx = _scalar(TIME_IDX)
+    last_tile = _scalar(LAST_TILE)
+    terminated = _scalar(TERMINATED, bool)
+
+    # The hand and meld masks as the rules helpers (AssertShanten, AssertHuForTrain) read them
+    hand_feature = property(lambda self: self._masks(self._hand_row))
+    is_peng = _mask("is_peng")
+    is_gang = _mask("is_gang")
+    is_chi = _mask("is_chi")
+    opponent_hand_features = _mask("opponent_hand_features")
+    opponent_is_pengs = _mask("opponent_is_pengs")
+    opponent_is_gangs = _mask("opponent_is_gangs")
+    opponent_is_chis = _mask("opponent_is_chis")
+
+    def bind(self, arena, obs_masks=None):
+        '''
+        Keep the game state in arena, a uint8 buffer of NBYTES bytes (e.g. one
+        row of a stacked batch). All state arrays are views into it and are
+        only ever updated in place, so the owner of the arena sees every change.
+        The hand and meld masks are only kept packed in the arena; the
+        opponents' observations unpack theirs into obs_masks of shape
+        (4, 4, 136), hand, pengs, gangs and chis per player (allocated here
+        by default). It is not game state and stays out of the arena.
+        '''
+        self.arena = arena
+        for name, view in views(arena).items():
+            setattr(self, name, view)
+        self.obs_masks = np.zeros((4, 4, 136), dtype=bool) if obs_masks is None else obs_masks
+        self.player_obs = [self._player_views(player) for player in range(4)]
+
+    def snapshot(self, out=None):
+        '''
+        The whole mutable game state (packed hands and melds, table, mountain
+        and its pointer, time_idx, who_is_play, win tiles, other_action,
+        counts and legal masks) as one flat uint8 array of NBYTES, copied into out (e.g. a row
+        of snapshot_buffer) when given. Agents are not part of it.
+        '''
+        if out is None:
+            out = np.empty(NBYTES, dtype=np.uint8)
+        np.copyto(out, self.arena)
+        return out
+
+    def restore(self, snap):
+        # Inverse of snapshot; claims are only pending inside a step, so none survive it
+        np.copyto(self.arena, snap)
+        self.special_play_action = [None for i in range(4)]
 
-        # Observation
+    def _load(self, rows):
+        # Unpack the mask rows a Ruler call is about to change into the scratch, which is returned
+        scratch = _scratch()
+        scratch[rows] = np.unpackbits(self.mask_bits[rows], axis=-1, count=136)
+        return scratch
+
+    def _pack(self, rows):
+        # Pack back the mask rows the Ruler just changed
+        self.mask_bits[rows] = np.packbits(_scratch()[rows], axis=-1)
+
+    def _masks(self, rows):
+        # Read-only 136-wide masks of the given rows, unpacked on demand
+        masks = np.unpackbits(self.mask_bits[rows], axis=-1, count=136).view(bool)
+        masks.flags.writeable = False
+        return masks
+
+    def _player_views(self, player):
+        '''
+        Observation of player as read-only views of the env state: the table is
+        shared, the draw is player's row of the opponent arrays, the hand and
+        melds are player's rows of obs_masks that _other_get_obs unpacks
+        into. The scalars are filled in per call; the arrays follow the game
+        and must be copied by an agent that wants to keep them.
+        '''
+        hand, peng, gang, chi = self.obs_masks[player]
+        obs = {"hand_feature": hand,
+            "table_played_feature": self.table_played_feature,
+            "table_who_feature": self.table_who_feature,
+            "table_whos": self.table_whos,
+            "time_feature": self.time_feature,
 
-        self.hand_feature = np.zeros(136, dtype=bool)  # maintain
-        self.table_played_feature = np.zeros(136, dtype=bool)  # not include hand maintain
-        self.table_who_feature = np.zeros((4, 136), dtype=bool)  # maintain
-        self.table_whos = np.zeros((4, 136), dtype=bool)  # maintain
-        self.time_feature = np.zeros(136, dtype=int)  # not one-hot maintain
+            "is_peng": peng,
+            "is_gang": gang,
+            "is_chi": chi,
 
-        self.is_peng = np.zeros(136, dtype=bool)  # maintain
-        self.is_gang = np.zeros(136, dtype=bool)  # maintain
-        self.is_chi = np.zeros(136, dtype=bool)  # maintain
+            "draw_tile": self.opponent_draw_tiles[player],
+            "other_new_played_tile": self.other_new_played_tile,
+            "who_is_play": self.who_is_play,
+            "legal_actions": self.opponent_legal_actions[player]
+        }
+        for name in obs:
+            obs[name] = obs[name].view()
+            obs[name].flags.writeable = False
+        obs["who_am_i"] = player
+        return obs
 
-        self.draw_tile = np.zeros(34, dtype=bool)  # refresh
-        self.other_new_played_tile = np.zeros(34, dtype=bool)  # refresh
-        self.who_is_play = np.zeros(4, dtype=bool)  # refresh
+    def _zero(self):
+        # Observation and info arrays are all cleared in place with the arena,
+        # time_feature is not one-hot, draw_tile/other_new_played_tile/who_is_play are refreshed
+        wind, dealer = self.wind, self.dealer
+        self.arena[:] = 0
 
         self.who_am_i = 0
-        self.wind = (self.wind + 1) % 16
+        self.wind = (wind + 1) % 16
 
-        # Info
-        self.opponent_hand_features = np.zeros((4, 136), dtype=bool)
-        self.opponent_draw_tiles = np.zeros((4, 34), dtype=bool)
-        
-        self.opponent_is_pengs = np.zeros((4, 136), dtype=bool)
-        self.opponent_is_gangs = np.zeros((4, 136), dtype=bool)
-        self.opponent_is_chis = np.zeros((4, 136), dtype=bool)
-
-        self.mountain = np.zeros(136, dtype=int)
-        self.mountain_ptr = 0 
         self.time_idx = -1 
-        self.dealer = (self.dealer + 1) % 4
-        self.last_tile = 0
-        self.win_tiles = np.zeros(4, dtype=int) 
-        self.win_types = np.zeros(4, dtype=int)
+        self.dealer = (dealer + 1) % 4
+        self.other_action[:] = -1
 
         self.special_play_action = [None for i in range(4)]
 
-        self.terminated = False
-
-        self.other_action = np.zeros((4, 2, 34), dtype=bool)
-
     def _fapai(self):
-        self.mountain = np.arange(136)
+        self.mountain[:] = np.arange(136)
         np.random.shuffle(self.mountain)
 
-        for i in range(13):
-            self.hand_feature[self.mountain[i]] = 1
-        for i in range(4):
-            if i != self.who_am_i:
-                for j in range(13):
-                    self.opponent_hand_features[i][self.mountain[i*13+j]] = 1
+        deal(self.mountain[None], self.mask_bits[None], self.who_am_i)
+        self._run(self._start())
 
+    def _start(self):
+        # Play begins after the deal with the player before the dealer
         self.who_is_play[(self.dealer+4-1)%4] = 1 
         self.mountain_ptr = 52
+        self._recount()
+        for player in range(4):
+            if player != self.who_am_i:
+                self._recount_opponent(player)
 
-        self._no_cpg_action()
+        yield from self._no_cpg_action()
+
+    def _legal(self):
+        # Own turn while holding 3n+2 tiles, otherwise a claim on the last discard
+        if self.hand_counts.sum() % 3 == 2:
+            phase = CLAIMED if self.other_action[self.who_am_i] // 34 in (3, 4, 7) else TURN
+            legal_actions(self.legal_actions, self.hand_counts, self.meld_counts[0], self.win_tiles[self.who_am_i], phase, cache=self.shape_cache)
+        else:
+            chi = (np.argmax(self.who_is_play) + 1) % 4 == self.who_am_i
+            legal_actions(self.legal_actions, self.hand_counts, self.meld_counts[0], self.last_tile, DISCARD, chi, self.shape_cache)
 
     def _get_obs(self):
-        self.other_new_played_tile = np.zeros(34, dtype=bool)
+        self.other_new_played_tile[:] = 0
         self.other_new_played_tile[self.last_tile] = True
-        return {"hand_feature": self.hand_feature,
+        self._legal()
+        hand, peng, gang, chi = self._masks(slice(0, 4))
+        return {"hand_feature": hand,
             "table_played_feature": self.table_played_feature,
             "table_who_feature": self.table_who_feature,
             "table_whos": self.table_whos,
             "time_feature": self.time_feature,
 
-            "is_peng": self.is_peng,
-            "is_gang": self.is_gang,
-            "is_chi": self.is_chi,
+            "is_peng": peng,
+            "is_gang": gang,
+            "is_chi": chi,
 
             "draw_tile": self.draw_tile,
             "other_new_played_tile": self.other_new_played_tile,
             "who_is_play": self.who_is_play,
+            "legal_actions": self.legal_actions,
 
             "who_am_i": self.who_am_i,
             "wind": self.wind,
             "is_last": self.mountain_ptr == 136
         } 
 
-    def _other_get_obs(self, player):
+    def _other_get_obs(self, player, phase, refresh=True):
+        # refresh=False when the caller has refreshed other_new_played_tile, player's legal masks and hand itself
         assert player != self.who_am_i
-        obs = deepcopy(self._get_obs())
-
-        obs["hand_feature"] = self.opponent_hand_features[player]
+        if refresh:
+            self.other_new_played_tile[:] = 0
+            self.other_new_played_tile[self.last_tile] = 1
+
+            legal = self.opponent_legal_actions[player]
+            if phase == DISCARD and self.who_is_play[player]: # nobody claims their own discard
+                legal[:] = 0
+                legal[0, 0] = 1
+            else:
+                tile = self.last_tile if phase == DISCARD else self.win_tiles[player]
+                chi = player == (np.argmax(self.who_is_play) + 1) % 4
+                legal_actions(legal, self.opponent_hand_counts[player], self.opponent_meld_counts[player, 0], tile, phase, chi, self.shape_cache)
 
-        obs["is_peng"] = self.opponent_is_pengs[player]
-        obs["is_gang"] = self.opponent_is_gangs[player]
-        obs["is_chi"] = self.opponent_is_chis[player]
+            # Hand, pengs, gangs and chis, unpacked byte by byte into player's rows
+            np.take(BITS, self.mask_bits[4 + player::4], axis=0, out=self.obs_masks[player].reshape(4, 17, 8), mode="clip")
 
-        obs["draw_tile"] = self.opponent_draw_tiles[player]
-        obs["other_new_played_tile"] = np.zeros(34, dtype=bool)
-        obs["other_new_played_tile"][self.last_tile] = 1
-
-        obs["who_am_i"] = player
+        obs = self.player_obs[player]
+        obs["wind"] = self.wind
+        obs["is_last"] = self.mountain_ptr == 136
 
         return obs
 
     def _get_info(self):
+        masks = self._masks(slice(4, 20))
         return {
-                "opponent_hand_features": self.opponent_hand_features, 
+                "opponent_hand_features": masks[0:4], 
                 "mountain": self.mountain, 
                 "mountain_ptr": self.mountain_ptr, 
                 
-                "opponent_is_pengs": self.opponent_is_pengs,
-                "opponent_is_gangs": self.opponent_is_gangs,
-                "opponent_is_chis": self.opponent_is_chis,
+                "opponent_is_pengs": masks[4:8],
+                "opponent_is_gangs": masks[8:12],
+                "opponent_is_chis": masks[12:16],
 
                 "time_idx": self.time_idx,
                 "dealer": self.dealer, 
@@ -200,8 +561,12 @@ class FapaiHimeEnv(gym.Env):
                     else:
                         reward += (8 + fan) * 3
             else:
-                self.hand_feature = self.opponent_hand_features[player]
-                fan = AssertHuForTrain(self, rev_map_34[self.win_tiles[player]], (player+4-self.dealer)%4, self.wind, self.mountain_ptr == 136)
+                # Evaluate the opponent's hand in place of ours, then put ours back
+                self._hand_row = MASK_ROWS["opponent_hand_features"].start + player
+                try:
+                    fan = AssertHuForTrain(self, rev_map_34[self.win_tiles[player]], (player+4-self.dealer)%4, self.wind, self.mountain_ptr == 136)
+                finally:
+                    self._hand_row = 0
                 if fan >= 8:
                     if self.win_types[player] == 2:
                         if np.argwhere(self.who_is_play!=0)[0][0] == self.who_am_i:
@@ -213,9 +578,28 @@ class FapaiHimeEnv(gym.Env):
                         
         return reward
 
-    def _get_shanten(self):
+    def _recount(self):
+        # Rebuild the shanten key from the packed hand; draws and plays then update it by their delta
+        counts = self._masks(slice(0, 4)).reshape(4, 34, 4).sum(axis=2)
+        self.hand_counts[:] = counts[0]
+        self.meld_counts[:] = counts[1:]
+
+    def _recount_opponent(self, player):
+        counts = self._masks(slice(4 + player, 20, 4)).reshape(4, 34, 4).sum(axis=2)
+        self.opponent_hand_counts[player] = counts[0]
+        self.opponent_meld_counts[player] = counts[1:]
+
+    def _shanten(self):
         return AssertShanten(self)
 
+    def _get_shanten(self, key=None):
+        # key is the cache key of the hand when the caller has built it already
+        if self.shanten_cache is None:
+            return self._shanten()
+        if key is None:
+            key = self.hand_counts.tobytes() + self.meld_counts.tobytes()
+        return self.shanten_cache.get(key, self._shanten)
+
     def _other_agents_draw_action(self, player):
             if self.mountain_ptr >= 136:
                 self.terminated = True
@@ -225,23 +609,27 @@ class FapaiHimeEnv(gym.Env):
                     
             self.win_tiles[player] = tile 
 
-            self.opponent_draw_tiles = np.zeros((4, 34), dtype=bool)
+            self.opponent_draw_tiles[:] = 0
             self.opponent_draw_tiles[player][tile] = 1
 
-            self.ruler.update_draw_tile(tile, self.opponent_hand_features, player)
-
-    def _other_agents_play_action(self, player, action):
-        tile = np.argwhere(action["my_played_output"]!=0)[0][0]
+            hands = self._load(4 + player)[4:8]
+            self.ruler.update_draw_tile(tile, hands, player)
+            self._pack(4 + player)
+            self.opponent_hand_counts[player, tile] += 1
 
+    def _other_agents_play_action(self, player, tile):
         self.last_tile = tile
-        self.other_new_played_tile = np.zeros(34, dtype=bool)
+        self.other_new_played_tile[:] = 0
         self.other_new_played_tile[tile] = 1
 
         self.time_idx += 1
 
+        hands = self._load(4 + player)[4:8]
         self.ruler.update_play_tile(tile, self.time_idx, player, 
-                self.opponent_hand_features, self.table_played_feature, 
+                hands, self.table_played_feature, 
                 self.table_who_feature, self.table_whos, self.time_feature, True)
+        self._pack(4 + player)
+        self.opponent_hand_counts[player, tile] -= 1
 
     def _boss_agent_draw_action(self):
         if self.mountain_ptr >= 136:
@@ -252,12 +640,42 @@ class FapaiHimeEnv(gym.Env):
 
         self.win_tiles[self.who_am_i] = tile 
 
-        self.draw_tile = np.zeros(34, dtype=bool) 
+        self.draw_tile[:] = 0
         self.draw_tile[tile] = 1
 
-        self.ruler.update_draw_tile(tile, self.hand_feature) 
+        hand = self._load(0)[0]
+        self.ruler.update_draw_tile(tile, hand) 
+        self._pack(0)
+        self.hand_counts[tile] += 1
         
 
+    def _ask(self, *requests):
+        '''
+        Suspend the turn on the decisions (player, phase) of requests; whoever
+        drives the turn generator (_run, or a vector env for many games at
+        once) sends back their action codes, which become other_action.
+        '''
+        codes = yield requests
+        for (player, phase), code in zip(requests, codes):
+            self.other_action[player] = code
+        return codes
+
+    def _decisions(self, requests, refresh=True):
+        # Agents, observations and previous action codes of pending requests, the arguments of decide
+        return ([self.other_agents[player] for player, phase in requests],
+            [self._other_get_obs(player, phase, refresh) for player, phase in requests],
+            [int(self.other_action[player]) for player, phase in requests])
+
+    def _run(self, turn):
+        # Drive a turn generator of this game alone and return its result
+        codes = None
+        while True:
+            try:
+                requests = turn.send(codes)
+            except StopIteration as stop:
+                return stop.value
+            codes = decide(*self._decisions(requests))
+
     def _no_cpg_action(self):
         player = np.argwhere(self.who_is_play!=0)[0][0]
         self.who_is_play[player] = 0
@@ -269,48 +687,22 @@ class FapaiHimeEnv(gym.Env):
             if return_value == -1:
                 return -1
 
-            obs = self._other_get_obs(player)
-
-            # Give other player last turn self action
-            tile_output = np.zeros(34, dtype=bool) 
-            action_output = np.zeros(8, dtype=bool)
-            for i in range(len(self.other_action[player][0])):
-                if self.other_action[player][0][i] == 1:
-                    action_output[i] = 1
-                
-            for i in range(len(self.other_action[player][1])):
-                if self.other_action[player][1][i] == 1:
-                    tile_output[i] = 1
-
-            pre_action = {"action_type_output": action_output, "my_played_output": tile_output}
-
-            action = self.other_agents[player].step(obs, pre_action)
-            action_type = action["action_type_output"]
-
-            # Maintain last action if have
-            self.other_action[player] = np.zeros((2, 34), dtype=bool)
-            for i in range(len(action_type)):
-                if action_type[i] == 1:
-                    self.other_action[player][0][i] = 1
-                
-            for i in range(len(action["my_played_output"])):
-                if action["my_played_output"][i] == 1:
-                    self.other_action[player][1][i] = 1
-
+            code, = yield from self._ask((player, TURN))
+            action_type = code // 34
 
-            assert action_type[1] == True or action_type[2] == True or action_type[5] == True or action_type[6] == True 
-            if action_type[1] == True:
-                self._other_agents_play_action(player, action)
+            assert action_type == 1 or action_type == 2 or action_type == 5 or action_type == 6 
+            if action_type == 1:
+                self._other_agents_play_action(player, code % 34)
 
-            elif action_type[2] == True:
+            elif action_type == 2:
                 self.terminated = True
-                if sum(self.opponent_hand_features[player]) % 3 == 1: 
+                if self.opponent_hand_counts[player].sum() % 3 == 1: 
                     raise ValueError
                 else:
                     self.win_types[player] = 1
 
             else: 
-                return_value = self._other_agents_confirmed_cpgh_action(player, action)
+                return_value = yield from self._other_agents_confirmed_cpgh_action(player, code)
                 if return_value == -1:
                     return -1
 
@@ -320,150 +712,119 @@ class FapaiHimeEnv(gym.Env):
             if return_value == -1:
                 return -1
 
-    def _other_agents_cpgh_action(self): 
-        for player in range(4):
-            if player != self.who_am_i: 
-                obs = self._other_get_obs(player)
-
-                # Give other player last trun self action
-                tile_output = np.zeros(34, dtype=bool) 
-                action_output = np.zeros(8, dtype=bool)
-                for i in range(len(self.other_action[player][0])):
-                    if self.other_action[player][0][i] == 1:
-                        action_output[i] = 1
-                
-                for i in range(len(self.other_action[player][1])):
-                    if self.other_action[player][1][i] == 1:
-                        tile_output[i] = 1
+    def _cpgh_result(self, player, code):
+        action_type = code // 34
+        assert action_type != 1 
 
-                pre_action = {"action_type_output": action_output, "my_played_output": tile_output}
+        if action_type == 2: 
+            self.terminated = True
+            if self.opponent_hand_counts[player].sum() % 3 == 1:
+                self.win_tiles[player] = self.last_tile
+                self.win_types[player] = 2
+            else: 
+                raise ValueError
 
-                action = self.other_agents[player].step(obs, pre_action)
-                action_type = action["action_type_output"]
+        elif action_type != 0: 
+            if action_type != 7 or player == (np.argwhere(self.who_is_play!=0)[0][0] + 1) % 4:
+                self.special_play_action[player] = code 
 
-                # Maintain last action if have
-                self.other_action[player] = np.zeros((2, 34), dtype=bool)
-                for i in range(len(action_type)):
-                    if action_type[i] == 1:
-                        self.other_action[player][0][i] = 1
-                
-                for i in range(len(action["my_played_output"])):
-                    if action["my_played_output"][i] == 1:
-                        self.other_action[player][1][i] = 1
-                assert action_type[1] == False 
-
-                if action_type[2] == True: 
-                    self.terminated = True
-                    if sum(self.opponent_hand_features[player]) % 3 == 1:
-                        self.win_tiles[player] = self.last_tile
-                        self.win_types[player] = 2
-                    else: 
-                        raise ValueError
-
-                elif action_type[0] == False: 
-                    if action_type[7] == False or player == (np.argwhere(self.who_is_play!=0)[0][0] + 1) % 4:
-                        self.special_play_action[player] = action 
+    def _other_agents_cpgh_action(self): 
+        # The opponents' claims on the last discard are independent, so they are decided together
+        players = [player for player in range(4) if player != self.who_am_i]
+        codes = yield from self._ask(*[(player, DISCARD) for player in players])
+        for player, code in zip(players, codes):
+            self._cpgh_result(player, code)
                 
-    def _other_agents_confirmed_cpgh_action(self, player, action):
-        action_type = action["action_type_output"]
-
-        tile = np.argwhere(action["my_played_output"])[0][0]
+    def _other_agents_confirmed_cpgh_action(self, player, code):
+        action_type = code // 34
+        tile = code % 34
 
 
         self.time_idx += 1 
 
-        self.other_new_played_tile = np.zeros(34, dtype=bool) 
+        self.other_new_played_tile[:] = 0
+        hands, pengs, gangs, chis = self._load(slice(4 + player, 20, 4))[4:].reshape(4, 4, 136)
         self.ruler.update_special_play(tile, self.time_idx, player, 
-                action_type, self.opponent_hand_features, self.table_played_feature, 
+                ACTION_TYPES[action_type], hands, self.table_played_feature, 
                 self.table_who_feature, self.table_whos, self.time_feature, 
-                self.opponent_is_pengs, self.opponent_is_gangs, self.opponent_is_chis, self.last_tile, True)
+                pengs, gangs, chis, self.last_tile, True)
+        self._pack(slice(4 + player, 20, 4))
+        self._recount_opponent(player)
 
-        if action_type[4] == True or action_type[5] == True or action_type[6] == True:
+        if action_type == 4 or action_type == 5 or action_type == 6:
             return_value = self._other_agents_draw_action(player)
             if return_value == -1:
                 return -1
 
-        obs = self._other_get_obs(player)
+        code, = yield from self._ask((player, CLAIMED))
+        action_type = code // 34
 
-        # Give other player last trun self action
-        tile_output = np.zeros(34, dtype=bool) 
-        action_output = np.zeros(8, dtype=bool)
-        for i in range(len(self.other_action[player][0])):
-            if self.other_action[player][0][i] == 1:
-                action_output[i] = 1
-    
-        for i in range(len(self.other_action[player][1])):
-            if self.other_action[player][1][i] == 1:
-                tile_output[i] = 1
-        pre_action = {"action_type_output": action_output, "my_played_output": tile_output}
-
-        action = self.other_agents[player].step(obs, pre_action)
-        action_type = action["action_type_output"]
-
-        # Maintain last action if have
-        self.other_action[player] = np.zeros((2, 34), dtype=bool)
-        for i in range(len(action_type)):
-            if action_type[i] == 1:
-                self.other_action[player][0][i] = 1
-    
-        for i in range(len(action["my_played_output"])):
-            if action["my_played_output"][i] == 1:
-                self.other_action[player][1][i] = 1
+        assert action_type == 1 or action_type == 2 
 
-
-        assert action_type[1] == True or action_type[2] == True 
-
-        if action_type[1] == True:
-            self._other_agents_play_action(player, action)
+        if action_type == 1:
+            self._other_agents_play_action(player, code % 34)
 
         else: 
             self.terminated = True
-            if sum(self.opponent_hand_features[player]) % 3 == 1: 
+            if self.opponent_hand_counts[player].sum() % 3 == 1: 
                 raise ValueError
             else:
                 self.win_types[player] = 1
 
 
-    def _turn(self, action):
+    def _turn(self, code):
+        # Generator of one step: yields the opponents' pending decisions and returns the kind of reward (see _reward)
+        self._boss_turn(code)
+        yield from self._other_agents_cpgh_action()
+        return (yield from self._resolve_turn(code))
+
+    def _boss_turn(self, code):
 
-        action_type = action["action_type_output"]
+        action_type = code // 34
+        self.other_action[self.who_am_i] = code
 
 
-        if action_type[0] == False: 
-            self.who_is_play = np.zeros(4, dtype=bool)
+        if action_type != 0: 
+            self.who_is_play[:] = 0
             self.who_is_play[self.who_am_i] = True
             player = self.who_am_i
 
-            if action_type[1] == True: 
-                tile = np.argwhere(action["my_played_output"])[0][0]
+            if action_type == 1: 
+                tile = code % 34
 
                 
                 self.last_tile = tile 
 
                 self.time_idx += 1 
 
+                hand = self._load(0)[0]
                 self.ruler.update_play_tile(tile, self.time_idx, player, 
-                        self.hand_feature, self.table_played_feature, 
+                        hand, self.table_played_feature, 
                         self.table_who_feature, self.table_whos, self.time_feature)
+                self._pack(0)
+                self.hand_counts[tile] -= 1
 
-            elif action_type[2] == True:
+            elif action_type == 2:
                 self.terminated = True
-                if sum(self.hand_feature) % 3 == 1:
+                if self.hand_counts.sum() % 3 == 1:
                     self.win_tiles[player] = self.last_tile
                     self.win_types[player] = 2
                 else:
                     self.win_types[player] = 1
 
             else: 
-                self.special_play_action[player] = action
+                self.special_play_action[player] = code
 
-        self._other_agents_cpgh_action()
+    def _resolve_turn(self, code):
+        # The strongest claim on the discard is played, otherwise the next player draws.
+        # Returns the type of the action that ended the turn, or None if the mountain ran out during it.
+        action_type = code // 34
 
         res = 0
         res_player = -1
         for player in range(4): 
             if self.special_play_action[player] != None:
-                special_play_type = np.argwhere(self.special_play_action[player]["action_type_output"])[0][0]
+                special_play_type = self.special_play_action[player] // 34
                 if res == 0 and special_play_type != 0:
                     res = special_play_type
                     res_player = player
@@ -474,51 +835,58 @@ class FapaiHimeEnv(gym.Env):
         if not self.terminated: 
             player = res_player
             if player != -1:
-                action = self.special_play_action[player]
-                action_type = action["action_type_output"]
-                self.who_is_play = np.zeros(4, dtype=bool)
+                code = self.special_play_action[player]
+                action_type = code // 34
+                self.who_is_play[:] = 0
                 self.who_is_play[player] = True
 
                 if player == self.who_am_i: 
-                    tile = np.argwhere(action["my_played_output"])[0][0] 
+                    tile = code % 34
 
                     self.time_idx += 1 
 
+                    hand, peng, gang, chi = self._load(slice(0, 4))[:4]
                     self.ruler.update_special_play(tile, self.time_idx, player, 
-                            action_type, self.hand_feature, self.table_played_feature, 
+                            ACTION_TYPES[action_type], hand, self.table_played_feature, 
                             self.table_who_feature, self.table_whos, self.time_feature,
-                            self.is_peng, self.is_gang, self.is_chi, self.last_tile, False)
+                            peng, gang, chi, self.last_tile, False)
+                    self._pack(slice(0, 4))
+                    self._recount()
 
-                    if action_type[4] == True or action_type[5] == True or action_type[6] == True:
+                    if action_type == 4 or action_type == 5 or action_type == 6:
                         return_value = self._boss_agent_draw_action()
                         if return_value == -1:
-                            return 0, self._get_obs(), self._get_info()
+                            return None
 
                 else: 
-                    return_value = self._other_agents_confirmed_cpgh_action(player, action)
+                    return_value = yield from self._other_agents_confirmed_cpgh_action(player, code)
                     if return_value == -1:
-                        return 0, self._get_obs(), self._get_info()
+                        return None
 
             else: 
-                return_value = self._no_cpg_action()
+                return_value = yield from self._no_cpg_action()
                 if return_value == -1:
-                    return 0, self._get_obs(), self._get_info()
+                    return None
 
         self.special_play_action = [None for player in range(4)]
+        return action_type
 
+    def _reward(self, action_type):
+        # Reward of a turn that _resolve_turn ended with action_type
+        if action_type is None:
+            return 0
         if self.terminated:
-            reward = 6 * (self._get_payoff() + 0.1)
-        elif action_type[3] == True or action_type[7] == True:
-            reward = 0 + 0.1
+            return 6 * (self._get_payoff() + 0.1)
+        elif action_type == 3 or action_type == 7:
+            return 0 + 0.1
         else:
-            reward = 6 - self._get_shanten() + 0.1
-            
-        return reward, self._get_obs(), self._get_info()
+            return 6 - self._get_shanten() + 0.1
 
     def step(self, action):
-        reward, observation, info = self._turn(action)
+        # action is an action code (action_type * 34 + tile) or the one-hot Dict form
+        reward = self._reward(self._run(self._turn(encode(action))))
 
-        return observation, reward, self.terminated, False, info
+        return self._get_obs(), reward, self.terminated, False, self._get_info()
 
     def close(self):
         pass
@@ -0,0 +1,360 @@
+import os
+import traceback
+from itertools import chain
+import multiprocessing as mp
+import numpy as np
+from gymnasium.vector.utils import batch_space
+from agents.random_agent import RandomAgent
+from fapaihime_env import FapaiHimeEnv, NBYTES, LAYOUT, MASK_ROWS, views, unpack, deal, decide, encode_batch, legal_actions_batch, \
+    TURN, CLAIMED, DISCARD, WHO_AM_I, WIND, MOUNTAIN_PTR, LAST_TILE, TERMINATED
+
+OBS_FIELDS = ["hand_feature", "table_played_feature", "table_who_feature", "table_whos", "time_feature",
+    "is_peng", "is_gang", "is_chi", "draw_tile", "other_new_played_tile", "who_is_play", "legal_actions"]
+INFO_FIELDS = ["opponent_hand_features", "mountain", "opponent_is_pengs", "opponent_is_gangs", "opponent_is_chis",
+    "win_tiles", "win_types"]
+
+
+class FapaiHimeVecEnv:
+    '''
+    K games of FapaiHimeEnv held in one stacked arena of shape (K, NBYTES).
+    Every game is a FapaiHimeEnv bound to its row, so the stacked views
+    (table_who_feature is (K, 4, 136), mountain (K, 136), mask_bits
+    (K, 20, 17), ...) always hold the state of all games and observations are
+    read from them without stacking dicts; the 136-wide hand and meld masks
+    are unpacked from mask_bits for all games at once. Shuffling and dealing
+    run over all resetting games at once, and so do termination, the legal
+    action masks and the rewards of a step (only the payoff of a finished
+    game and shanten cache misses call into the rules). The turn rules (Ruler
+    and the opponents, draws included) still run table by table, but every
+    game suspends on its opponents' decisions (claims, own turns, plays after
+    a claim) and the pending decisions of all games are decided together, so
+    an agent with a step_batch method shared by many seats gets one call per
+    round, at most three per step. Finished
+    games are reset automatically and their last observation and info are
+    kept in infos["final_observation"] / infos["final_info"].
+    '''
+    def __init__(self, K, other_agents=None, copy=True):
+        if other_agents is None:
+            other_agents = [[RandomAgent() for i in range(4)] for k in range(K)]
+        assert len(other_agents) == K
+
+        self.num_envs = K
+        self.copy = copy # with copy=False the returned arrays are views that the next step overwrites
+        self.arena = np.zeros((K, NBYTES), dtype=np.uint8)
+        self.state = views(self.arena)
+        self.obs_masks = np.zeros((K, 4, 4, 136), dtype=bool) # the opponents' unpacked hands and melds
+        self.envs = [FapaiHimeEnv(other_agents[k]) for k in range(K)]
+        self.shanten_cache = self.envs[0].shanten_cache
+        self.shape_cache = self.envs[0].shape_cache
+        for k, env in enumerate(self.envs):
+            env.bind(self.arena[k], self.obs_masks[k])
+            env.wind = -1
+            env.dealer = -1
+
+        self.single_observation_space = self.envs[0].observation_space
+        self.single_action_space = self.envs[0].action_space
+        self.observation_space = batch_space(self.single_observation_space, K)
+        self.action_space = batch_space(self.single_action_space, K)
+        self.rng = np.random.default_rng()
+
+    def _reset_rows(self, rows):
+        for k in rows:
+            self.envs[k]._zero()
+
+        # Shuffle and deal every resetting game at once
+        mountain = np.argsort(self.rng.random((len(rows), 136)), axis=1)
+        self.state["mountain"][rows] = mountain
+        deal(mountain, self.state["mask_bits"], self.state["scalars"][rows, WHO_AM_I], rows)
+        self._drive({k: self.envs[k]._start() for k in rows})
+        self._legal(rows)
+
+    def _legal(self, rows):
+        # The boss's legal action masks of the given games, as FapaiHimeEnv._legal
+        s = self.state
+        who = s["scalars"][rows, WHO_AM_I]
+        counts = s["hand_counts"][rows]
+        own = counts.sum(axis=1) % 3 == 2
+        claimed = np.isin(s["other_action"][rows, who] // 34, (3, 4, 7))
+        phase = np.where(own, np.where(claimed, CLAIMED, TURN), DISCARD)
+        tile = np.where(own, s["win_tiles"][rows, who], s["scalars"][rows, LAST_TILE])
+        chi = (np.argmax(s["who_is_play"][rows], axis=1) + 1) % 4 == who
+        legal = np.empty((len(rows), 8, 34), dtype=bool)
+        legal_actions_batch(legal, counts, s["meld_counts"][rows, 0], tile, phase, chi, self.shape_cache)
+        s["legal_actions"][rows] = legal
+
+    def _legal_requests(self, pending):
+        # other_new_played_tile, the opponents' legal masks and hands of all pending requests, as FapaiHimeEnv._other_get_obs
+        s = self.state
+        games = np.array([k for k, requests in pending.items() for r in requests])
+        players = np.array([player for requests in pending.values() for player, phase in requests])
+        phase = np.array([phase for requests in pending.values() for player, phase in requests])
+        last_tile = s["scalars"][games, LAST_TILE]
+        s["other_new_played_tile"][games] = 0
+        s["other_new_played_tile"][games, last_tile] = 1
+
+        discard = phase == DISCARD
+        tile = np.where(discard, last_tile, s["win_tiles"][games, players])
+        chi = players == (np.argmax(s["who_is_play"][games], axis=1) + 1) % 4
+        legal = np.empty((len(games), 8, 34), dtype=bool)
+        legal_actions_batch(legal, s["opponent_hand_counts"][games, players], s["opponent_meld_counts"][games, players, 0], tile, phase, chi, self.shape_cache)
+        own = discard & s["who_is_play"][games, players] # nobody claims their own discard
+        legal[own] = 0
+        legal[own, 0, 0] = 1
+        s["opponent_legal_actions"][games, players] = legal
+
+        # Hand, pengs, gangs and chis of every requesting player, unpacked in one go into the rows its observation views
+        bits = s["mask_bits"][games[:, None], 4 + players[:, None] + np.arange(0, 16, 4)]
+        self.obs_masks[games, players] = np.unpackbits(bits, axis=-1, count=136).view(bool)
+
+    def _rewards(self, kinds, terminated):
+        # FapaiHimeEnv._reward of every game from the kinds its turn returned, shanten keys built for all games at once
+        s = self.state
+        K = self.num_envs
+        rewards = np.zeros(K)
+        kind = np.array([-1 if kinds[k] is None else kinds[k] for k in range(K)])
+        for k in np.flatnonzero(terminated & (kind >= 0)):
+            rewards[k] = self.envs[k]._reward(kinds[k])
+        claim = np.isin(kind, (3, 7))
+        rewards[~terminated & claim] = 0 + 0.1
+
+        rows = np.flatnonzero(~terminated & (kind >= 0) & ~claim)
+        keys = np.concatenate((s["hand_counts"][rows], s["meld_counts"][rows].reshape(len(rows), -1)), axis=1)
+        rewards[rows] = [6 - self.envs[k]._get_shanten(key.tobytes()) + 0.1 for k, key in zip(rows, keys)]
+        return rewards
+
+    def _drive(self, turns):
+        '''
+        Run the turn generators of several games (game -> generator) in
+        lockstep: every round the decisions all of them are waiting for go to
+        one decide() call. Returns the result of every generator by game.
+        '''
+        res = {}
+        codes = {k: None for k in turns}
+        while len(codes) > 0:
+            pending = {}
+            for k, c in codes.items():
+                try:
+                    pending[k] = turns[k].send(c)
+                except StopIteration as stop:
+                    res[k] = stop.value
+            if len(pending) == 0:
+                break
+
+            self._legal_requests(pending)
+            asks = [self.envs[k]._decisions(requests, False) for k, requests in pending.items()]
+            actions = iter(decide(*[list(chain.from_iterable(a[i] for a in asks)) for i in range(3)]))
+            codes = {k: [next(actions) for r in requests] for k, requests in pending.items()}
+        return res
+
+    def _out(self, rows=None):
+        # Observations and infos of all games, or copies of those of the given rows
+        s = self.state
+        if rows is None:
+            rows = np.arange(self.num_envs)
+            pick = np.copy if self.copy else (lambda x: x)
+        else:
+            pick = lambda x: x[rows]
+
+        # other_new_played_tile is refreshed from last_tile, as FapaiHimeEnv._get_obs does
+        s["other_new_played_tile"][rows] = 0
+        s["other_new_played_tile"][rows, s["scalars"][rows, LAST_TILE]] = 1
+
+        bits = s["mask_bits"][rows]
+        obs = {name: unpack(bits, name) if name in MASK_ROWS else pick(s[name]) for name in OBS_FIELDS}
+        obs["who_am_i"] = s["scalars"][rows, WHO_AM_I]
+        obs["wind"] = s["scalars"][rows, WIND]
+        obs["is_last"] = s["scalars"][rows, MOUNTAIN_PTR] == 136
+        info = {name: unpack(bits, name) if name in MASK_ROWS else pick(s[name]) for name in INFO_FIELDS}
+        return obs, info
+
+    def reset(self, seed=None, options=None):
+        if seed is not None:
+            self.rng = np.random.default_rng(seed)
+        self._reset_rows(np.arange(self.num_envs))
+        return self._out()
+
+    def step(self, actions):
+        '''
+        actions is a (K,) array of action codes (action_type * 34 + tile) or a
+        batch of the one-hot Dict form: "my_played_output" of shape (K, 34)
+        and "action_type_output" of shape (K, 8).
+        '''
+        codes = encode_batch(actions).tolist()
+        kinds = self._drive({k: env._turn(codes[k]) for k, env in enumerate(self.envs)})
+        terminated = self.state["scalars"][:, TERMINATED] != 0
+        rewards = self._rewards(kinds, terminated)
+        self._legal(np.arange(self.num_envs))
+
+        infos = {}
+        done = np.flatnonzero(terminated)
+        if len(done) > 0:
+            final_obs, final_info = self._out(done)
+            infos["final_observation"] = final_obs
+            infos["final_info"] = final_info
+            infos["_final_observation"] = terminated.copy()
+            self._reset_rows(done)
+
+        obs, info = self._out()
+        infos.update(info)
+        return obs, rewards, terminated, np.zeros(self.num_envs, dtype=bool), infos
+
+    def close(self):
+        pass
+
+
+def _shared(ctx, dtype, shape):
+    # Zeroed shared-memory block for an array of dtype and shape
+    return ctx.RawArray("b", max(1, np.dtype(dtype).itemsize * int(np.prod(shape))))
+
+
+def _info_layout(K):
+    # dtype and shape of every INFO_FIELDS entry over K games, as FapaiHimeVecEnv returns them
+    layout = {}
+    for name in INFO_FIELDS:
+        if name in MASK_ROWS:
+            rows = MASK_ROWS[name]
+            layout[name] = (bool, (K, rows.stop - rows.start, 136))
+        else:
+            off, dtype, shape = LAYOUT[name]
+            layout[name] = (dtype, (K,) + shape)
+    return layout
+
+
+def _array(block, dtype, shape):
+    return np.frombuffer(block, dtype=dtype, count=int(np.prod(shape))).reshape(shape)
+
+
+def _worker(lo, hi, layout, blocks, pipe, make_agents):
+    # Runs games lo .. hi-1 of an async vector env and writes their results into the shared blocks
+    try:
+        venv = FapaiHimeVecEnv(hi-lo, None if make_agents is None else [make_agents() for k in range(hi-lo)], copy=False)
+        out = {name: _array(blocks[name], dtype, shape)[lo:hi] for name, (dtype, shape) in layout.items()}
+        while True:
+            cmd, data = pipe.recv()
+            if cmd == "reset":
+                obs, infos = venv.reset(seed=data)
+            elif cmd == "step":
+                obs, reward, terminated, truncated, infos = venv.step(data)
+                out["reward"][:] = reward
+                out["terminated"][:] = terminated
+            else:
+                break
+            for name in venv.single_observation_space.spaces:
+                out[name][:] = obs[name]
+            for name in INFO_FIELDS:
+                out[name][:] = infos[name]
+            # Only the rare auto-reset records go through the pipe
+            pipe.send((True, {name: infos[name] for name in ("final_observation", "final_info", "_final_observation") if name in infos}))
+    except Exception:
+        pipe.send((False, traceback.format_exc()))
+    finally:
+        pipe.close()
+
+
+class FapaiHimeAsyncVecEnv:
+    '''
+    K games split over worker processes, each running a FapaiHimeVecEnv on
+    its share. Workers write observations, infos, rewards and terminations
+    straight into shared-memory blocks laid out like observation_space (one
+    (K, *shape) block per key, in the space's dtype) and the INFO_FIELDS of
+    FapaiHimeVecEnv, so the learner reads them without pickling and gets
+    the same infos from either vector env. step_async only sends the actions, so policy
+    inference can overlap with simulation until step_wait. make_agents is a
+    picklable callable returning the 4 agents of one game.
+    '''
+    def __init__(self, K, workers=None, make_agents=None, copy=True, context=None):
+        workers = min(K, workers or os.cpu_count())
+        ctx = mp.get_context(context)
+
+        self.num_envs = K
+        self.copy = copy # with copy=False the returned arrays are the shared blocks themselves
+        probe = FapaiHimeEnv()
+        self.single_observation_space = probe.observation_space
+        self.single_action_space = probe.action_space
+        self.observation_space = batch_space(self.single_observation_space, K)
+        self.action_space = batch_space(self.single_action_space, K)
+
+        layout = {name: (space.dtype, (K,) + space.shape) for name, space in self.single_observation_space.spaces.items()}
+        layout.update(_info_layout(K))
+        layout["reward"] = (np.float64, (K,))
+        layout["terminated"] = (bool, (K,))
+        blocks = {name: _shared(ctx, dtype, shape) for name, (dtype, shape) in layout.items()}
+        self.buffers = {name: _array(blocks[name], dtype, shape) for name, (dtype, shape) in layout.items()}
+
+        bounds = np.linspace(0, K, workers+1).astype(int)
+        self.slices = [slice(bounds[w], bounds[w+1]) for w in range(workers)]
+        self.pipes = []
+        self.procs = []
+        for w in range(workers):
+            parent, child = ctx.Pipe()
+            proc = ctx.Process(target=_worker, args=(bounds[w], bounds[w+1], layout, blocks, child, make_agents), daemon=True)
+            proc.start()
+            child.close()
+            self.pipes.append(parent)
+            self.procs.append(proc)
+        self.waiting = False
+        self.closed = False
+
+    def _recv(self):
+        res = []
+        for pipe in self.pipes:
+            ok, data = pipe.recv()
+            if not ok:
+                raise RuntimeError("FapaiHimeAsyncVecEnv worker failed:\n" + data)
+            res.append(data)
+        return res
+
+    def _obs(self):
+        take = np.copy if self.copy else (lambda x: x)
+        return {name: take(self.buffers[name]) for name in self.single_observation_space.spaces}
+
+    def _info(self):
+        take = np.copy if self.copy else (lambda x: x)
+        return {name: take(self.buffers[name]) for name in INFO_FIELDS}
+
+    def reset(self, seed=None, options=None):
+        assert not self.waiting
+        for w, pipe in enumerate(self.pipes):
+            pipe.send(("reset", None if seed is None else [seed, w]))
+        self._recv()
+        return self._obs(), self._info()
+
+    def step_async(self, actions):
+        assert not self.waiting
+        for sl, pipe in zip(self.slices, self.pipes):
+            pipe.send(("step", encode_batch(actions)[sl]))
+        self.waiting = True
+
+    def step_wait(self):
+        assert self.waiting
+        res = self._recv()
+        self.waiting = False
+
+        infos = {}
+        done = [w for w in range(len(res)) if "_final_observation" in res[w]]
+        if len(done) > 0:
+            # Final records of the finished games, in game order
+            infos["_final_observation"] = np.concatenate([res[w].get("_final_observation", np.zeros(sl.stop-sl.start, dtype=bool)) for w, sl in enumerate(self.slices)])
+            for key in ("final_observation", "final_info"):
+                infos[key] = {name: np.concatenate([res[w][key][name] for w in done]) for name in res[done[0]][key]}
+
+        infos.update(self._info())
+        reward = self.buffers["reward"].copy()
+        terminated = self.buffers["terminated"].copy()
+        return self._obs(), reward, terminated, np.zeros(self.num_envs, dtype=bool), infos
+
+    def step(self, actions):
+        self.step_async(actions)
+        return self.step_wait()
+
+    def close(self):
+        if self.closed:
+            return
+        if self.waiting:
+            self._recv()
+        for pipe in self.pipes:
+            pipe.send(("close", None))
+            pipe.close()
+        for proc in self.procs:
+            proc.join()
+        self.closed = True
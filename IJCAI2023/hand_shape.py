@@ -0,0 +1,89 @@
+from itertools import permutations
+
+'''
+Winning hand shapes on the 34 tile counts of a concealed hand (melds
+excluded): four melds and a pair (fewer melds after claims), seven pairs,
+thirteen orphans, honors and knitted tiles, and a knitted straight with a
+meld and a pair. Only the shape is checked, whether the hand reaches 8 fan
+is left to AssertHuForTrain when the game is scored.
+'''
+
+ORPHANS = [0, 8, 9, 17, 18, 26] + list(range(27, 34))
+# The six knitted arrangements 147/258/369 over the three suits
+KNITS = [frozenset(9*suit + perm[suit] + 3*j for suit in range(3) for j in range(3)) for perm in permutations(range(3))]
+
+
+def _melds(c, i=0):
+    # Whether the counts c[i:] split into pungs and chows
+    while i < 34 and c[i] == 0:
+        i += 1
+    if i == 34:
+        return True
+    if c[i] >= 3:
+        c[i] -= 3
+        ok = _melds(c, i)
+        c[i] += 3
+        if ok:
+            return True
+    if i < 27 and i % 9 <= 6 and c[i+1] > 0 and c[i+2] > 0:
+        c[i] -= 1
+        c[i+1] -= 1
+        c[i+2] -= 1
+        ok = _melds(c, i)
+        c[i] += 1
+        c[i+1] += 1
+        c[i+2] += 1
+        return ok
+    return False
+
+
+def _standard(c):
+    # Melds and one pair: the pair sits in the only suit (or honor) whose tile count is 2 mod 3
+    pair = None
+    for lo in (0, 9, 18):
+        r = sum(c[lo:lo+9]) % 3
+        if r == 1 or (r == 2 and pair is not None):
+            return False
+        if r == 2:
+            pair = range(lo, lo+9)
+    for t in range(27, 34):
+        if c[t] == 1 or c[t] == 4 or (c[t] == 2 and pair is not None):
+            return False
+        if c[t] == 2:
+            pair = [t]
+
+    for i in pair:
+        if c[i] >= 2:
+            c[i] -= 2
+            ok = _melds(c)
+            c[i] += 2
+            if ok:
+                return True
+    return False
+
+
+def complete(counts):
+    c = counts.tolist() # plain ints recurse much faster than numpy scalars
+    n = sum(c)
+    if n % 3 != 2:
+        return False
+    if _standard(c):
+        return True
+    if n != 14: # the other shapes are fully concealed
+        return False
+
+    if all(x % 2 == 0 for x in c): # seven pairs, four of a kind counts as two
+        return True
+    held = [t for t in range(34) if c[t] > 0]
+    if len(held) == 13 and all(c[t] > 0 for t in ORPHANS):
+        return True
+    for knit in KNITS:
+        if len(held) == 14 and all(t in knit or t >= 27 for t in held): # honors and knitted tiles
+            return True
+        if all(c[t] > 0 for t in knit): # knitted straight, a meld and a pair
+            rest = list(c)
+            for t in knit:
+                rest[t] -= 1
+            if _standard(rest):
+                return True
+    return False
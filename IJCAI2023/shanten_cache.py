@@ -0,0 +1,56 @@
+import sys
+from collections import OrderedDict
+
+
+class ShantenCache:
+    '''
+    Bounded LRU cache of shanten numbers. The key is the compact hand
+    encoding the env keeps up to date incrementally: 34 int8 tile counts of
+    the hand followed by the per-tile counts of its pengs, gangs and chis.
+    Hands repeat a lot over training, so most steps skip AssertShanten. The
+    winning-shape flags of the legal action masks are kept in an instance of
+    their own (fapaihime_env.SHAPE_CACHE), so the stats here stay those of
+    the shanten numbers.
+    '''
+    def __init__(self, maxsize=1 << 18):
+        self.maxsize = maxsize
+        self.table = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.bytes = 0
+
+    def __len__(self):
+        return len(self.table)
+
+    def get(self, key, compute, *args):
+        # Cached value of key, or compute(*args) stored under it
+        value = self.table.get(key)
+        if value is not None:
+            self.table.move_to_end(key)
+            self.hits += 1
+            return value
+
+        self.misses += 1
+        value = compute(*args)
+        self.table[key] = value
+        self.bytes += sys.getsizeof(key)
+        if len(self.table) > self.maxsize:
+            old, _ = self.table.popitem(last=False)
+            self.bytes -= sys.getsizeof(old)
+        return value
+
+    def clear(self):
+        self.table.clear()
+        self.bytes = 0
+
+    def stats(self):
+        # Hit rate and an estimate of the memory held: keys plus about 100 bytes of dict entry each
+        calls = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / calls if calls > 0 else 0.0,
+            "size": len(self.table),
+            "maxsize": self.maxsize,
+            "bytes": self.bytes + 100 * len(self.table),
+        }